@@ -0,0 +1,126 @@
+"""
+Compares the latency of evaluating a candidate in a cold process, that has to import the test
+modules and discover the tests, with the warm worker pool used by the search.
+
+$ python benchmarks/evaluation_latency.py [candidates] [import_seconds]
+
+The test module imports a dependency that takes import_seconds to import, like numpy or pandas.
+"""
+import multiprocessing
+import os
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent))  # run from a checkout of the repo
+
+slow_dependency = '''
+import time
+time.sleep({import_seconds})  # Simulates a heavy import, like numpy or pandas
+'''
+
+sources = '''
+from unvibe import ai
+
+
+@ai
+def double(x):
+    """Returns twice x"""
+    pass
+'''
+
+tests = '''
+import unvibe
+import slow_dependency
+from sources import double
+
+
+class DoubleTestClass(unvibe.TestCase):
+    def test_double(self):
+        self.assertEqual(double(2), 4)
+        self.assertEqual(double(-1), -2)
+'''
+
+config = '''
+[ai]
+provider = "ollama"
+model = "none"
+
+[search]
+cache = false
+'''
+
+impls = {'double': 'def double(x):\n    return x * 2\n'}
+
+
+def write_project(folder: Path, import_seconds):
+    (folder / 'slow_dependency.py').write_text(slow_dependency.format(import_seconds=import_seconds))
+    (folder / 'sources.py').write_text(sources)
+    (folder / 'test_double.py').write_text(tests)
+    (folder / '.unvibe.toml').write_text(config)
+
+
+def evaluate_cold(folder, conn):
+    """A fresh interpreter: imports unvibe and the test modules, discovers the tests and runs them"""
+    os.chdir(folder)
+    sys.path.insert(0, folder)
+    from unvibe import magic_entities
+    from unvibe.evaluator import evaluate_impls
+    from unvibe.tests_container import FolderPatternTestsContainer
+    tests_container = FolderPatternTestsContainer(folder, 'test*.py')
+    tests_container.generate_test_suite()
+    conn.send(evaluate_impls(tests_container, magic_entities, impls))
+
+
+def bench_cold(folder, candidates):
+    context = multiprocessing.get_context('spawn')
+    latencies = []
+    for _ in range(candidates):
+        start = time.perf_counter()
+        receiver, sender = context.Pipe(duplex=False)
+        process = context.Process(target=evaluate_cold, args=(folder, sender))
+        process.start()
+        outcome = receiver.recv()
+        process.join()
+        latencies.append(time.perf_counter() - start)
+        assert outcome['score'] == 1, outcome
+    return latencies
+
+
+def bench_warm(folder, candidates):
+    os.chdir(folder)
+    sys.path.insert(0, folder)
+    from unvibe import magic_entities
+    from unvibe.evaluator import ProcessPoolEvaluator
+    from unvibe.tests_container import FolderPatternTestsContainer
+    tests_container = FolderPatternTestsContainer(folder, 'test*.py')
+    tests_container.generate_test_suite()
+    limits = {'timeout': 60, 'cpu_seconds': None, 'memory_mb': None}
+    evaluator = ProcessPoolEvaluator(tests_container, magic_entities, workers=1, limits=limits)
+    latencies = []
+    for _ in range(candidates):
+        start = time.perf_counter()
+        outcome = evaluator.evaluate(impls)
+        latencies.append(time.perf_counter() - start)
+        assert outcome['score'] == 1, outcome
+    evaluator.close()
+    return latencies
+
+
+def main():
+    candidates = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    import_seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 1.0
+    with tempfile.TemporaryDirectory() as folder:
+        write_project(Path(folder), import_seconds)
+        os.environ['UNITAI_CONFIG'] = str(Path(folder) / '.unvibe.toml')
+        cold = bench_cold(folder, candidates)
+        warm = bench_warm(folder, candidates)
+    print(f'{candidates} candidates, test dependencies take {import_seconds}s to import')
+    print(f'cold evaluation: median {statistics.median(cold) * 1000:8.1f} ms')
+    print(f'warm evaluation: median {statistics.median(warm) * 1000:8.1f} ms')
+
+
+if __name__ == '__main__':
+    main()
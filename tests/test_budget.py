@@ -0,0 +1,40 @@
+import unittest
+
+from unvibe.budget import Budget, budget_from_config
+from unvibe.usage import Usage
+
+
+def usage(tokens, cache_hit=False):
+    return Usage('ollama', 'llama3.2', tokens, 0, 0.1, cache_hit)
+
+
+class BudgetTest(unittest.TestCase):
+
+    def test_unlimited(self):
+        budget = Budget()
+        budget.add_llm_call(usage(10 ** 9))
+        budget.add_evaluation()
+        self.assertIsNone(budget.exceeded())
+        self.assertEqual(budget.remaining(), '')
+
+    def test_limits(self):
+        budget = Budget(max_total_tokens=100, max_llm_calls=3, max_evaluations=2)
+        budget.add_llm_call(usage(40))
+        budget.add_llm_call(usage(1000, cache_hit=True))
+        budget.add_evaluation()
+        self.assertIsNone(budget.exceeded())
+        self.assertEqual(budget.remaining(), 'Left: 60 tokens, 2 LLM calls, 1 evaluations')
+        budget.add_evaluation()
+        self.assertEqual(budget.exceeded(), 'max_evaluations=2')
+        budget.add_llm_call(usage(60))
+        self.assertEqual(budget.exceeded(), 'max_total_tokens=100')
+        self.assertEqual(len(budget.usages), 3)
+
+    def test_minutes(self):
+        self.assertIsNone(Budget(max_minutes=1).exceeded())
+        self.assertEqual(Budget(max_minutes=0).exceeded(), 'max_minutes=0')
+
+    def test_from_search_config(self):
+        budget = budget_from_config({'max_llm_calls': 1})
+        budget.add_llm_call(usage(10))
+        self.assertEqual(budget.exceeded(), 'max_llm_calls=1')
@@ -0,0 +1,45 @@
+import unittest
+
+from unvibe.cascade import Cascade, cascade_from_config
+
+local = {'provider': 'ollama', 'model': 'qwen2.5-coder:7b', 'max_depth': 3}
+haiku = {'provider': 'claude', 'model': 'claude-3-5-haiku-latest'}
+sonnet = {'provider': 'claude', 'model': 'claude-3-7-sonnet-latest'}
+
+
+class CascadeTest(unittest.TestCase):
+
+    def test_single_tier(self):
+        cascade = Cascade([haiku])
+        for _ in range(5):
+            self.assertFalse(cascade.update(0))
+        self.assertEqual(cascade.ai_config(), haiku)
+
+    def test_escalates_on_plateau(self):
+        cascade = Cascade([dict(local, max_depth=None), haiku, sonnet], patience=2)
+        self.assertEqual(cascade.ai_config(), {'provider': 'ollama', 'model': 'qwen2.5-coder:7b'})
+        self.assertFalse(cascade.update(0.2))
+        self.assertFalse(cascade.update(0.5))
+        self.assertFalse(cascade.update(0.5))
+        self.assertTrue(cascade.update(0.5))
+        self.assertEqual(cascade.ai_config(), haiku)
+        self.assertFalse(cascade.update(0.5))
+        self.assertTrue(cascade.update(0.5))
+        self.assertEqual(cascade.ai_config(), sonnet)
+        # The last tier is kept
+        for _ in range(5):
+            self.assertFalse(cascade.update(0.5))
+
+    def test_escalates_on_tier_depth(self):
+        cascade = Cascade([local, haiku], patience=10)
+        self.assertFalse(cascade.update(0.1))
+        self.assertFalse(cascade.update(0.2))
+        self.assertTrue(cascade.update(0.3))
+        self.assertEqual(cascade.ai_config(), haiku)
+
+    def test_from_portfolio_settings(self):
+        # A search of a portfolio merges its tiers over its own ai settings
+        cascade = cascade_from_config(local, [{'model': 'qwen2.5-coder:32b'}], {'cascade_patience': 1})
+        self.assertEqual(cascade.ai_config(), {'provider': 'ollama', 'model': 'qwen2.5-coder:32b'})
+        self.assertEqual(cascade.patience, 1)
+        self.assertEqual(cascade_from_config(haiku, [], {}).tiers, [haiku])
@@ -1,9 +1,12 @@
 import inspect
 import unittest
+from random import Random
 
 from unvibe import TestCase, ai
 from unvibe.tests_container import count_assertions
-from unvibe.core import cleanup_error_str, parse_ai_output, remove_extra_indentation
+from unvibe.core import cleanup_error_str, parse_ai_output, remove_extra_indentation, group_temperatures, \
+    get_temperatures
+from unvibe.fingerprint import fingerprint
 from unvibe.magic import cleanup_implementation, MagicClass
 
 
@@ -77,6 +80,76 @@ class CoreTest(unittest.TestCase):
         self.assertEqual(len(impls_dict), 1)
         self.assertIn('s == s[::-1]', impls_dict['is_palindrome'])
 
+    def test_fingerprint(self):
+        impl = '''
+def mean(values):
+    """Average of the values"""
+    total = 0
+    for value in values:
+        total += value  # accumulate
+    return total / len(values)
+'''
+        renamed = '''
+def mean(values):
+    acc = 0
+
+    for x in values:
+        acc += x
+    return acc / len(values)
+'''
+        different_constant = renamed.replace('acc = 0', 'acc = 1')
+        self.assertEqual(fingerprint({'mean': impl}), fingerprint({'mean': renamed}))
+        self.assertNotEqual(fingerprint({'mean': impl}), fingerprint({'mean': different_constant}))
+        self.assertIsNone(fingerprint({'mean': 'def mean(:'}))
+
+    def test_fingerprint_keeps_parameter_names(self):
+        # The parameters can be passed by keyword: their names are part of the API
+        impl = 'def sort(xs, reverse=False):\n    return sorted(xs, reverse=reverse)\n'
+        self.assertNotEqual(fingerprint({'sort': impl}),
+                            fingerprint({'sort': impl.replace('reverse=reverse', 'reverse=descending')
+                                        .replace('reverse=False', 'descending=False')}))
+        method = 'class Stack:\n    def push(self, item):\n        self.items.append(item)\n'
+        self.assertNotEqual(fingerprint({'Stack': method}), fingerprint({'Stack': method.replace('item', 'value')}))
+        # A parameter that shadows a local of the enclosing function is not renamed in its body
+        nested = 'def f(a):\n    x = a\n    return lambda x: x + 1\n'
+        self.assertNotEqual(fingerprint({'f': nested}), fingerprint({'f': nested.replace('x + 1', 'a + 1')}))
+
+    def test_group_temperatures(self):
+        temperatures = [0, 0.5, 0.1, 0.3, 0.7, 0.2]
+        self.assertEqual(group_temperatures(temperatures, 1), [(t, 1) for t in temperatures])
+        requests = group_temperatures(temperatures, 2)
+        self.assertEqual([samples for _, samples in requests], [1, 2, 2, 1])
+        self.assertEqual(requests[0], (0, 1))
+        self.assertAlmostEqual(requests[1][0], 0.15)
+        self.assertEqual(sum(samples for _, samples in group_temperatures(temperatures, 4)), len(temperatures))
+
+    def test_seeded_temperatures(self):
+        search_config = {'random_spread': 3, 'max_temperature': 0.5, 'seed': 42}
+        first = get_temperatures(1, search_config, Random(42))
+        self.assertEqual(first, get_temperatures(1, search_config, Random(42)))
+        self.assertEqual(first[0], 0)
+        self.assertTrue(all(0 <= t <= 0.5 for t in first))
+
+    def test_quantized_temperatures(self):
+        search_config = {'random_spread': 4, 'max_temperature': 0.5, 'temperature_step': 0.1}
+        temperatures = get_temperatures(1, search_config, Random(1))
+        self.assertEqual(temperatures[0], 0)
+        # Different multiples of the step, while there are enough
+        self.assertEqual(len(set(temperatures[1:])), 4)
+        self.assertTrue(set(temperatures[1:]) <= {0.1, 0.2, 0.3, 0.4, 0.5})
+        search_config['random_spread'] = 7
+        self.assertEqual(len(get_temperatures(1, search_config, Random(1))), 8)
+        # A deterministic search: the temperatures would all be 0, so it's asked once
+        search_config['max_temperature'] = 0
+        self.assertEqual(get_temperatures(1, search_config, Random(1)), [0])
+
+    def test_increasing_temperatures(self):
+        search_config = {'random_spread': 2, 'random_type': 'increasing'}
+        self.assertEqual(get_temperatures(1, search_config, drawn=0), [0, 0.001])
+        self.assertEqual(get_temperatures(1, search_config, drawn=2), [0.002, 0.003])
+        # Searches don't take the temperatures of each other
+        self.assertEqual(get_temperatures(1, search_config, drawn=0), [0, 0.001])
+
     def test_cleanup_error_str(self):
         error_str = '''
             Traceback (most recent call last):
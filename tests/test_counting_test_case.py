@@ -48,3 +48,18 @@ class TestCountingTestCase(TestCase):
         self.assertEqual(state.failed_assertions, 3)
         self.assertEqual(state.executed_assertions, 6)
         self.assertAlmostEquals(state.score, 0.428, 2)
+
+    def test_tests_discovered_once(self):
+        tests_container = ClassTestsContainer(self.TestClass)
+        first_suite = tests_container.generate_test_suite()
+        test_index = tests_container.test_index
+        second_suite = tests_container.generate_test_suite()
+        self.assertIs(tests_container.test_index, test_index)
+        self.assertEqual(len(test_index), 4)
+        for first_test, second_test in zip(first_suite, second_suite):
+            self.assertIsNot(first_test, second_test)
+        for test_suite in [first_suite, second_suite]:
+            runner = unittest.TextTestRunner(resultclass=UnvibeTestResult)
+            result = runner.run(test_suite)
+            self.assertEqual(result.testsRun, 4)
+            self.assertEqual(result.ass_passed, 3)
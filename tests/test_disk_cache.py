@@ -0,0 +1,128 @@
+import multiprocessing
+import os
+import pickle
+import tempfile
+import unittest
+
+from unvibe import disk_cache
+from unvibe.config import config
+
+
+def store_many(prefix, count):
+    for i in range(count):
+        disk_cache.store(f'{prefix}_{i}', i)
+
+
+class TestDiskCache(unittest.TestCase):
+    def setUp(self):
+        self.search_config = dict(config['search'])
+        disk_cache.memory_cache.clear()
+        disk_cache.touched.clear()
+        self.old_cwd = os.getcwd()
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        os.chdir(self.tmp_dir.name)
+
+    def tearDown(self):
+        if getattr(disk_cache.local, 'conn', None) is not None:
+            disk_cache.local.conn.close()
+            disk_cache.local.conn = None
+        os.chdir(self.old_cwd)
+        self.tmp_dir.cleanup()
+        config['search'] = self.search_config
+
+    def test_store_and_lookup(self):
+        self.assertEqual(disk_cache.lookup('missing'), (False, None))
+        disk_cache.store('key', {'text': 'hello'})
+        self.assertEqual(disk_cache.lookup('key'), (True, {'text': 'hello'}))
+        self.assertEqual(disk_cache.get_keys(), {'key'})
+        disk_cache.reset_cache()
+        self.assertEqual(disk_cache.get_keys(), set())
+
+    def test_retire_legacy_pickle(self):
+        with open(disk_cache.legacy_cache_file, 'wb') as f:
+            pickle.dump({'a': 1, 'b': 'two'}, f)
+        # Its keys can't be produced by any lookup: nothing is imported
+        self.assertEqual(disk_cache.get_keys(), set())
+        self.assertFalse(os.path.exists(disk_cache.legacy_cache_file))
+        self.assertTrue(os.path.exists(disk_cache.legacy_cache_file + '.unused'))
+
+    def test_cache_key(self):
+        key = disk_cache.cache_key('claude', 'haiku', 'system', 'def f():\n    pass', 0.3)
+        self.assertEqual(len(key), 64)
+        self.assertEqual(key, disk_cache.cache_key('claude', 'haiku', 'system', 'def f():\n    pass', 0.3))
+        self.assertNotEqual(key, disk_cache.cache_key('claude', 'sonnet', 'system', 'def f():\n    pass', 0.3))
+
+    def test_normalize_text(self):
+        self.assertEqual(disk_cache.normalize_text('\ndef f():  \n\n\n    pass\n'),
+                         disk_cache.normalize_text('def f():\n    pass'))
+        self.assertNotEqual(disk_cache.normalize_text('def f():\n    pass'),
+                            disk_cache.normalize_text('def f():\npass'))
+
+    def test_disk_cached_stores_prompt(self):
+        calls = []
+
+        def key_func(system, prompt):
+            return disk_cache.cache_key(system, disk_cache.normalize_text(prompt)), system + prompt
+
+        def call_llm(system, prompt):
+            calls.append(prompt)
+            return 'response'
+
+        config['search']['cache'] = True
+        cached_call = disk_cache.disk_cached(key_func=key_func)(call_llm)
+        self.assertEqual(cached_call('system', 'prompt\n'), 'response')
+        self.assertEqual(cached_call('system', 'prompt  '), 'response')
+        self.assertEqual(len(calls), 1)
+        row = disk_cache.connect().execute('SELECT prompt FROM cache').fetchone()
+        self.assertEqual(row[0], 'systemprompt\n')
+
+    def test_memory_tier(self):
+        config['search']['cache_memory_entries'] = 2
+        for key in ['a', 'b', 'c']:
+            disk_cache.store(key, key.upper())
+        self.assertEqual(list(disk_cache.memory_cache.keys()), ['b', 'c'])
+        self.assertEqual(disk_cache.lookup('a'), (True, 'A'))  # from disk, then back in memory
+        self.assertEqual(list(disk_cache.memory_cache.keys()), ['c', 'a'])
+
+    def test_memory_hits_refresh_disk_lru(self):
+        config['search']['cache_max_mb'] = 1
+        disk_cache.store('hot', os.urandom(200 * 1024))
+        for i in range(8):
+            # Answered by the memory tier only
+            self.assertTrue(disk_cache.lookup('hot')[0])
+            disk_cache.store(f'key{i}', os.urandom(200 * 1024))
+        keys = disk_cache.get_keys()
+        self.assertIn('hot', keys)
+        self.assertNotIn('key0', keys)
+
+    def test_ttl(self):
+        disk_cache.store('old', 1)
+        with disk_cache.connect() as conn:
+            conn.execute('UPDATE cache SET created_at = 0')
+        disk_cache.memory_cache.clear()
+        config['search']['cache_ttl_days'] = 1
+        self.assertEqual(disk_cache.lookup('old'), (False, None))
+        disk_cache.store('new', 2)
+        self.assertEqual(disk_cache.get_keys(), {'new'})
+
+    def test_max_mb_evicts_least_recently_used(self):
+        config['search']['cache_max_mb'] = 1
+        for i in range(8):
+            disk_cache.store(f'key{i}', os.urandom(200 * 1024))
+        keys = disk_cache.get_keys()
+        self.assertLess(len(keys), 8)
+        self.assertIn('key7', keys)
+        self.assertNotIn('key0', keys)
+        self.assertLessEqual(disk_cache.used_bytes(disk_cache.connect()), 1024 * 1024)
+
+    @unittest.skipUnless('fork' in multiprocessing.get_all_start_methods(), 'requires fork')
+    def test_concurrent_processes(self):
+        disk_cache.store('parent', 0)  # the children must not reuse this connection
+        context = multiprocessing.get_context('fork')
+        processes = [context.Process(target=store_many, args=(f'p{p}', 50)) for p in range(4)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+            self.assertEqual(process.exitcode, 0)
+        self.assertEqual(len(disk_cache.get_keys()), 4 * 50 + 1)
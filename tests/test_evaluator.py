@@ -0,0 +1,125 @@
+import multiprocessing
+import threading
+import time
+import unittest
+
+import unvibe
+from unvibe import ai
+from unvibe.evaluator import InProcessEvaluator, ProcessPoolEvaluator, MemoizedEvaluator, outcomes, \
+    failed_outcome, outcome_key
+from unvibe.tests_container import ClassTestsContainer
+
+
+class TestEvaluator(unittest.TestCase):
+    def setUp(self):
+        unvibe.reset()
+        outcomes.clear()
+
+        @ai
+        def mul(a, b):
+            pass
+
+        class MulTestClass(unvibe.TestCase):
+            def test_mul(self):
+                self.assertEqual(mul(2, 3), 6)
+                self.assertEqual(mul(2, 2), 4)
+
+            def test_mul_zero(self):
+                self.assertEqual(mul(0, 3), 0)
+
+        self.mes = [mul]
+        self.tests_container = ClassTestsContainer(MulTestClass)
+        self.right = {'mul': 'def mul(a, b):\n    return a * b\n'}
+        self.wrong = {'mul': 'def mul(a, b):\n    return a * b or 1\n'}
+        self.limits = {'timeout': 60, 'cpu_seconds': None, 'memory_mb': None}
+
+    def check_outcomes(self, evaluator):
+        outcome = evaluator.evaluate(self.right)
+        self.assertEqual(outcome['score'], 1)
+        self.assertEqual(outcome['passed_assertions'], 3)
+        self.assertEqual(outcome['errors'], [])
+        outcome = evaluator.evaluate(self.wrong)
+        self.assertAlmostEqual(outcome['score'], 2 / 3)
+        self.assertEqual(outcome['failed_assertions'], 1)
+        self.assertEqual(len(outcome['errors']), 1)
+        self.assertIsNone(self.mes[0].impl)
+
+    def test_in_process(self):
+        self.check_outcomes(InProcessEvaluator(self.tests_container, self.mes))
+
+    @unittest.skipUnless('fork' in multiprocessing.get_all_start_methods(), 'requires fork')
+    def test_process_pool(self):
+        evaluator = ProcessPoolEvaluator(self.tests_container, self.mes, workers=2, limits=self.limits)
+        try:
+            self.check_outcomes(evaluator)
+        finally:
+            evaluator.close()
+
+    @unittest.skipUnless('fork' in multiprocessing.get_all_start_methods(), 'requires fork')
+    def test_limits(self):
+        self.limits.update(timeout=1, cpu_seconds=2, memory_mb=2048)
+        evaluator = ProcessPoolEvaluator(self.tests_container, self.mes, workers=1, limits=self.limits)
+        try:
+            outcome = evaluator.evaluate({'mul': 'def mul(a, b):\n    while True:\n        pass\n'})
+            self.assertEqual(outcome['score'], 0)
+            self.assertEqual(outcome['errors'], ['The tests timed out after 1s. Is there an infinite loop?'])
+            outcome = evaluator.evaluate({'mul': 'def mul(a, b):\n    return len(bytearray(8 * 1024 ** 3))\n'})
+            self.assertEqual(outcome['score'], 0)
+            self.assertIn('MemoryError', outcome['errors'][0])
+            # The worker is still usable after a candidate was killed
+            self.check_outcomes(evaluator)
+        finally:
+            evaluator.close()
+
+    @unittest.skipUnless('fork' in multiprocessing.get_all_start_methods(), 'requires fork')
+    def test_cancelled(self):
+        evaluator = ProcessPoolEvaluator(self.tests_container, self.mes, workers=1, limits=self.limits)
+        try:
+            cancelled = threading.Event()
+            threading.Timer(0.3, cancelled.set).start()
+            start = time.monotonic()
+            outcome = evaluator.evaluate({'mul': 'def mul(a, b):\n    while True:\n        pass\n'}, cancelled)
+            # The child is killed long before the timeout of 60s
+            self.assertLess(time.monotonic() - start, 5)
+            self.assertEqual(outcome['errors'], ['The evaluation was cancelled.'])
+            # The worker is still usable after a candidate was cancelled
+            self.check_outcomes(evaluator)
+        finally:
+            evaluator.close()
+
+    def test_memoized(self):
+        runs = []
+
+        class CountingEvaluator(InProcessEvaluator):
+            def evaluate(self, impls, cancelled=None):
+                runs.append(impls)
+                return super().evaluate(impls)
+
+        evaluator = MemoizedEvaluator(CountingEvaluator(self.tests_container, self.mes),
+                                      self.tests_container.get_source(), persist=False)
+        self.check_outcomes(evaluator)
+        self.assertEqual(len(runs), 2)
+        # Same implementations, up to whitespace: the tests don't run again
+        outcome = evaluator.evaluate({'mul': '\ndef mul(a, b):  \n\n    return a * b'})
+        self.assertEqual(outcome['score'], 1)
+        self.assertEqual(len(runs), 2)
+
+    def test_memoized_skips_resource_guards(self):
+        runs = []
+
+        class TimingOutEvaluator(InProcessEvaluator):
+            def evaluate(self, impls, cancelled=None):
+                runs.append(impls)
+                return failed_outcome('The tests timed out after 1s. Is there an infinite loop?')
+
+        evaluator = MemoizedEvaluator(TimingOutEvaluator(self.tests_container, self.mes),
+                                      self.tests_container.get_source(), persist=False)
+        for _ in range(2):
+            outcome = evaluator.evaluate(self.right)
+            self.assertEqual(outcome['score'], 0)
+            self.assertNotIn('resource_guard', outcome)
+        # A timeout may not happen again: the tests run every time
+        self.assertEqual(len(runs), 2)
+        self.assertEqual(len(outcomes), 0)
+        self.assertNotEqual(outcome_key('tests', self.right, {'memory_mb': 1024}),
+                            outcome_key('tests', self.right, {'memory_mb': 2048}))
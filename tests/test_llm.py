@@ -0,0 +1,368 @@
+import os
+import threading
+import time
+import unittest
+from types import SimpleNamespace
+
+import anthropic
+import ollama
+from google import genai
+
+from unvibe import llm
+from unvibe.core import parse_ai_output
+from unvibe import ai
+from unvibe.llm import get_client, ImplementTracker, build_prompt, Scheduler, TokenBucket, LLMUnavailable, \
+    LatencyTracker, Cancelled, call_hedged, hedge_config, get_latency_tracker, ollama_options, \
+    AnyEvent, call_provider, ai_call
+from unvibe.state import State
+
+
+class FakeClient:
+    instances = 0
+
+    def __init__(self, api_key, host=None):
+        FakeClient.instances += 1
+        self.api_key = api_key
+        self.host = host
+
+
+class FakeAPIError(Exception):
+    def __init__(self, status_code, retry_after=None):
+        super().__init__(f'HTTP {status_code}')
+        self.status_code = status_code
+        self.response = type('Response', (), {'headers': {'retry-after': retry_after} if retry_after else {}})()
+
+
+def failing(errors):
+    """A provider call that raises the errors, then answers"""
+    calls = []
+
+    def call():
+        calls.append(1)
+        if len(calls) <= len(errors):
+            raise errors[len(calls) - 1]
+        return {'text': 'ok', 'output_tokens': 10}
+
+    return call, calls
+
+
+answer = '<implement name="mul">\ndef mul(a, b):\n    return a * b\n</implement>'
+
+
+def answer_chunks():
+    return [answer[i:i + 10] for i in range(0, len(answer), 10)] + [' and some commentary']
+
+
+class FakeClaudeStream:
+    def __init__(self):
+        self.text_stream = iter(answer_chunks())
+        usage = SimpleNamespace(input_tokens=10, output_tokens=None, cache_read_input_tokens=90,
+                                cache_creation_input_tokens=0)
+        self.current_message_snapshot = SimpleNamespace(usage=usage)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+def fake_gemini_stream(model, contents):
+    usage = SimpleNamespace(prompt_token_count=100, candidates_token_count=20, cached_content_token_count=None)
+    return (SimpleNamespace(text=chunk, usage_metadata=usage) for chunk in answer_chunks())
+
+
+class FakeOpenAIStream:
+    """Streams one choice only, whatever n is, like some OpenAI-compatible servers"""
+
+    def __init__(self, **kwargs):
+        self.read = []
+        self.closed = False
+        self.chunks = [SimpleNamespace(model='m', usage=None,
+                                       choices=[SimpleNamespace(index=0, delta=SimpleNamespace(content=chunk))])
+                       for chunk in answer_chunks()]
+
+    def __iter__(self):
+        for chunk in self.chunks:
+            self.read.append(chunk)
+            yield chunk
+
+    def close(self):
+        self.closed = True
+
+
+def fake_ollama_chat(model, messages, options, keep_alive, stream=False):
+    return (SimpleNamespace(message=SimpleNamespace(content=chunk), done=False) for chunk in answer_chunks())
+
+
+# The clients that the provider calls of LLMTest.test_call_provider get: (provider, client class, settings, client)
+fake_clients = [
+    ('claude', anthropic.Anthropic, {'api_key': 'k', 'max_retries': 0},
+     SimpleNamespace(messages=SimpleNamespace(stream=lambda **kwargs: FakeClaudeStream()))),
+    ('gemini', genai.Client, {'api_key': 'k'},
+     SimpleNamespace(models=SimpleNamespace(generate_content_stream=fake_gemini_stream))),
+    ('ollama', ollama.Client, {'host': 'http://fake'}, SimpleNamespace(chat=fake_ollama_chat)),
+]
+
+
+@ai
+def mul(a, b):
+    pass
+
+
+class LLMTest(unittest.TestCase):
+
+    def test_get_client(self):
+        FakeClient.instances = 0
+        client = get_client(FakeClient, api_key='a')
+        self.assertIs(get_client(FakeClient, api_key='a'), client)
+        self.assertIsNot(get_client(FakeClient, api_key='b'), client)
+        self.assertIsNot(get_client(FakeClient, api_key='a', host='http://localhost:11434'), client)
+        self.assertEqual(FakeClient.instances, 3)
+
+    def test_get_client_concurrent(self):
+        FakeClient.instances = 0
+        got = []
+        threads = [threading.Thread(target=lambda: got.append(get_client(FakeClient, api_key='c'))) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(FakeClient.instances, 1)
+        self.assertTrue(all(client is got[0] for client in got))
+
+    def test_implement_tracker(self):
+        answer = ('Here you go:\n<implement name="mul">\ndef mul(a, b):\n    return a * b\n</implement>\n'
+                  '<implement name="div">\ndef div(a, b):\n    return a / b\n</implement>')
+        commentary = '\nThe functions multiply and divide. <implement name="extra">...'
+        tracker = ImplementTracker(['mul', 'div'])
+        stream = answer + commentary
+        chunks = [stream[i:i + 5] for i in range(0, len(stream), 5)]
+        fed = 0
+        for chunk in chunks:
+            fed += 1
+            if tracker.feed(chunk):
+                break
+        self.assertLess(fed, len(chunks))
+        self.assertEqual(tracker.answer(), answer)
+        self.assertEqual(parse_ai_output(tracker.answer()), parse_ai_output(answer))
+
+    def test_implement_tracker_split_tags(self):
+        # The end tags are split between chunks, one character at a time
+        answer = '<implement name="mul">\nreturn a * b\n</implement><implement name="div">\nreturn a / b\n</implement>'
+        tracker = ImplementTracker(['mul', 'div'])
+        done = [tracker.feed(c) for c in answer + ' and some commentary']
+        self.assertEqual(done.index(True), len(answer) - 1)
+        self.assertEqual(tracker.answer(), answer)
+
+    def test_implement_tracker_incomplete(self):
+        tracker = ImplementTracker(['mul', 'div'])
+        self.assertFalse(tracker.feed('<implement name="mul">\ndef mul(a, b): pass\n</implement>'))
+        self.assertFalse(tracker.feed(None))
+        self.assertEqual(tracker.answer(), '<implement name="mul">\ndef mul(a, b): pass\n</implement>')
+        self.assertFalse(ImplementTracker(None).feed('<implement name="mul">\n</implement>'))
+
+    def test_build_prompt(self):
+        orig_context = 'def mul(a, b):\n    pass\n'
+        tests = 'class MulTest(TestCase):\n    def test_mul(self):\n        self.assertEqual(mul(2, 3), 6)\n'
+        first = build_prompt([mul], orig_context, '', tests, [])
+        second = build_prompt([mul], orig_context, 'def mul(a, b):\n    return a + b\n', tests,
+                              ['AssertionError: 5 != 6'])
+        # Only the suffix changes between the requests of a search
+        self.assertEqual(first[0], second[0])
+        self.assertIn(orig_context, first[0])
+        self.assertIn(tests, first[0])
+        self.assertIn('return a + b', second[1])
+        self.assertIn('AssertionError: 5 != 6', second[1])
+
+    def test_changed_context(self):
+        state = State()
+        state.orig_context = 'import math\n'
+        self.assertEqual(state.changed_context(), '')
+        state.context = 'import math\ndef mul(a, b):\n    return a * b\n'
+        self.assertEqual(state.changed_context(), 'def mul(a, b):\n    return a * b\n')
+
+    def test_token_bucket(self):
+        bucket = TokenBucket(60)  # one per second
+        self.assertEqual(bucket.reserve(60), 0)
+        self.assertAlmostEqual(bucket.reserve(2), 2, places=1)
+
+    def test_scheduler_retries(self):
+        scheduler = Scheduler('fake', max_retries=3, backoff_seconds=0.01)
+        call, calls = failing([FakeAPIError(429, retry_after='0.01'), FakeAPIError(503), ConnectionError()])
+        self.assertEqual(scheduler.call(call)['text'], 'ok')
+        self.assertEqual(len(calls), 4)
+
+        call, calls = failing([FakeAPIError(500)] * 5)
+        with self.assertRaises(LLMUnavailable):
+            scheduler.call(call)
+        self.assertEqual(len(calls), 4)
+
+        # Errors that a retry doesn't fix are raised at once
+        call, calls = failing([FakeAPIError(401)])
+        with self.assertRaises(FakeAPIError):
+            scheduler.call(call)
+        self.assertEqual(len(calls), 1)
+
+    def test_scheduler_circuit_breaker(self):
+        scheduler = Scheduler('fake', max_retries=1, backoff_seconds=0.01, breaker_failures=2, breaker_seconds=60)
+        call, calls = failing([FakeAPIError(502)] * 2)
+        with self.assertRaises(LLMUnavailable):
+            scheduler.call(call)
+        # The provider is not called while the circuit is open
+        with self.assertRaises(LLMUnavailable):
+            scheduler.call(call)
+        self.assertEqual(len(calls), 2)
+
+    def test_latency_percentile(self):
+        tracker = LatencyTracker(size=20)
+        for latency in range(1, 10):
+            tracker.add(latency)
+        self.assertIsNone(tracker.percentile(90))
+        tracker.add(10)
+        self.assertEqual(tracker.percentile(90), 9)
+        self.assertEqual(tracker.percentile(100), 10)
+
+    def test_hedge_config(self):
+        ai_config = {'provider': 'claude', 'model': 'a', 'api_key': 'k', 'hedge': {'model': 'b'}}
+        self.assertEqual(hedge_config(ai_config), {'provider': 'claude', 'model': 'b', 'api_key': 'k'})
+        self.assertEqual(hedge_config({'provider': 'ollama', 'model': 'a'}), {'provider': 'ollama', 'model': 'a'})
+
+    def test_call_hedged(self):
+        calls = []
+        cancels = []
+
+        def call_provider(ai_config, system, prefix, suffix, temperature, expected, cancelled=None):
+            calls.append(ai_config['model'])
+            cancels.append(cancelled)
+            if ai_config['model'] == 'slow':
+                # Like the streams of the providers, stop reading when cancelled
+                for _ in range(30):
+                    if cancelled is not None and cancelled.is_set():
+                        raise Cancelled()
+                    time.sleep(0.01)
+            return {'text': ai_config['model'], 'texts': [ai_config['model']], 'model': ai_config['model'],
+                    'input_tokens': 10, 'output_tokens': 5}, False
+
+        orig_call_provider = llm.call_provider
+        llm.call_provider = call_provider
+        try:
+            ai_config = {'provider': 'fake', 'model': 'slow', 'hedge': {'model': 'fast'}}
+            tracker = get_latency_tracker(ai_config)
+            for _ in range(10):
+                tracker.add(0.05)
+            response, hit, hedged = call_hedged(ai_config, 'system', 'prefix', 'suffix', 0, ['mul'],
+                                                hedge_percentile=90)
+            self.assertEqual(response['text'], 'fast')
+            self.assertTrue(hedged)
+            self.assertFalse(hit)
+            # The cancelled request is billed too
+            self.assertGreater(response['input_tokens'], 10)
+            self.assertEqual(calls, ['slow', 'fast'])
+            # The loser is cancelled before call_hedged returns
+            self.assertTrue(cancels[0].is_set())
+            # The primary lost the race: its latency is at least the delay of the hedge
+            self.assertEqual(len(tracker.latencies), 11)
+            self.assertGreaterEqual(tracker.latencies[-1], 0.05)
+
+            # Fast enough: no hedge
+            calls.clear()
+            response, hit, hedged = call_hedged({'provider': 'fake', 'model': 'fast'}, 's', 'p', 's', 0, ['mul'],
+                                                hedge_percentile=90)
+            self.assertFalse(hedged)
+            self.assertEqual(calls, ['fast'])
+
+            # Without hedge_percentile, the slow request is not hedged
+            calls.clear()
+            response, hit, hedged = call_hedged(ai_config, 's', 'p', 's', 0, ['mul'])
+            self.assertFalse(hedged)
+            self.assertEqual(calls, ['slow'])
+        finally:
+            llm.call_provider = orig_call_provider
+
+    def test_scheduler_slots(self):
+        scheduler = Scheduler('fake', max_concurrent=2)
+        running, peak = [0], [0]
+        lock = threading.Lock()
+
+        def call():
+            with lock:
+                running[0] += 1
+                peak[0] = max(peak[0], running[0])
+            time.sleep(0.02)
+            with lock:
+                running[0] -= 1
+            return {'text': 'ok'}
+
+        threads = [threading.Thread(target=scheduler.call, args=(call,)) for _ in range(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(peak[0], 2)
+
+    def test_ollama_options(self):
+        ai_config = {'provider': 'ollama', 'model': 'qwen2.5-coder:7b', 'num_ctx': 16384, 'num_predict': 1024}
+        self.assertEqual(ollama_options(ai_config, 0.5), {'temperature': 0.5, 'num_ctx': 16384, 'num_predict': 1024})
+        self.assertEqual(ollama_options({'provider': 'ollama', 'model': 'm'}), {})
+
+    def test_cancelled(self):
+        stop, ended = threading.Event(), threading.Event()
+        cancelled = AnyEvent(stop, ended, None)
+        self.assertFalse(cancelled.is_set())
+        call, calls = failing([])
+
+        def request(cancelled=None):
+            return call()
+
+        scheduler = Scheduler('fake')
+        self.assertEqual(scheduler.call(request, cancelled=cancelled)['text'], 'ok')
+        ended.set()
+        # The requests of a search that ended are not sent, nor retried
+        with self.assertRaises(Cancelled):
+            scheduler.call(request, cancelled=cancelled)
+        self.assertEqual(len(calls), 1)
+
+    def test_call_openai_fewer_choices(self):
+        streams = []
+
+        def create(**kwargs):
+            streams.append(FakeOpenAIStream(**kwargs))
+            return streams[-1]
+
+        client = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create)))
+        key = (os.getpid(), llm.OpenAI, (('api_key', 'k'), ('base_url', 'http://fake'), ('max_retries', 0)))
+        llm.clients[key] = client
+        try:
+            ai_config = {'provider': 'openai', 'model': 'm', 'api_key': 'k', 'base_url': 'http://fake',
+                         'max_tokens': 100}
+            response, hit = call_provider(ai_config, 'system', 'prefix', 'suffix', 0.5, ['mul'], samples=2)
+            # The missing choice is not an empty answer, and doesn't keep the stream open
+            self.assertEqual(response['texts'], [answer])
+            self.assertTrue(streams[0].closed)
+            self.assertEqual(len(streams[0].read), len(streams[0].chunks) - 1)
+        finally:
+            llm.clients.pop(key, None)
+
+    def test_call_provider(self):
+        # Every provider is called with the options of a single request
+        keys = []
+        try:
+            for provider, client_class, settings, client in fake_clients:
+                key = (os.getpid(), client_class, tuple(sorted(settings.items())))
+                keys.append(key)
+                llm.clients[key] = client
+                ai_config = {'provider': provider, 'model': 'm', 'api_key': 'k', 'host': 'http://fake'}
+                response, hit = call_provider(ai_config, 'system', 'prefix', 'suffix', 0.5, ['mul'])
+                self.assertEqual(response['texts'], [answer], provider)
+                self.assertEqual(response['provider'], provider)
+                self.assertGreater(response['input_tokens'], 0)
+                # The same through ai_call, that adds the sampling options
+                for samples in [1, 2]:
+                    prompt, texts, usage = ai_call([mul], 'def mul(a, b):\n    pass\n', '', 'tests', [], 0.5,
+                                                   samples, ai_config)
+                    self.assertEqual(texts, [answer] * samples, provider)
+                    self.assertEqual(usage.provider, provider)
+        finally:
+            for key in keys:
+                llm.clients.pop(key, None)
@@ -92,3 +92,28 @@ To fix the `is_palindrome` function, we need to correctly check if a string read
         is_palindrome.set_impl(cleanup_implementation(impl_dict['is_palindrome'], is_palindrome.__class__))
         self.assertEqual(is_palindrome('ciao'), False)
         self.assertEqual(is_palindrome('anna'), True)
+
+    def test_impl_compiled_once(self):
+        @ai
+        def next_id():
+            pass
+
+        next_id.set_impl('import itertools\n'
+                         'counter = itertools.count()\n'
+                         'def next_id():\n'
+                         '    return next(counter)\n')
+        # The module-level code of the implementation runs only once, in set_impl
+        self.assertEqual([next_id(), next_id(), next_id()], [0, 1, 2])
+        next_id.set_impl(None)
+        with self.assertRaises(Exception):
+            next_id()
+
+    def test_impl_error_raised_on_call(self):
+        @ai
+        def div(a, b):
+            pass
+
+        div.set_impl('def div(a, b):\n    return a / b\nundefined_name\n')
+        for _ in range(2):
+            with self.assertRaises(NameError):
+                div(1, 2)
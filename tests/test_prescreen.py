@@ -0,0 +1,41 @@
+import unittest
+
+from unvibe import ai
+from unvibe.prescreen import prescreen
+
+
+@ai
+def mean(values, weights=None):
+    pass
+
+
+@ai
+class Stack:
+    pass
+
+
+class PrescreenTest(unittest.TestCase):
+
+    def test_valid(self):
+        impl = 'import math\n\ndef mean(values, weights=None):\n    return math.fsum(values) / len(values)\n'
+        self.assertIsNone(prescreen(impl, mean))
+        self.assertIsNone(prescreen('class Stack:\n    def push(self, x):\n        self.items = [x]\n', Stack))
+
+    def test_syntax_error(self):
+        error = prescreen('def mean(values):\n  return 1\n    return 2\n', mean)
+        self.assertIn('IndentationError', error)
+        self.assertIn('line 3', error)
+
+    def test_missing_definition(self):
+        self.assertIn('"def mean"', prescreen('def average(values):\n    return 0\n', mean))
+        self.assertIn('"class Stack"', prescreen('def Stack():\n    return []\n', Stack))
+
+    def test_signature(self):
+        self.assertIn('must accept the same arguments', prescreen('def mean(values, weights, n):\n    return 0\n', mean))
+        self.assertIn('must accept the same arguments', prescreen('def mean(values):\n    return 0\n', mean))
+        self.assertIsNone(prescreen('def mean(*args):\n    return 0\n', mean))
+
+    def test_undefined_names(self):
+        error = prescreen('def mean(values, weights=None):\n    return fsum(values) / len(values)\n', mean)
+        self.assertEqual(error, "NameError: name 'fsum' is not defined (line 2)")
+        self.assertIsNone(prescreen('from math import *\n\ndef mean(values, weights=None):\n    return fsum(values)\n', mean))
@@ -0,0 +1,29 @@
+import unittest
+
+from unvibe.llm import read_response, make_response
+from unvibe.usage import Usage, summarize_usage
+
+
+class UsageTest(unittest.TestCase):
+
+    def test_summary(self):
+        usages = [Usage('claude', 'haiku', 100, 20, 1.5, False),
+                  Usage('claude', 'haiku', 100, 30, 0.01, True),
+                  Usage('claude', 'haiku', 200, 40, 2.5, False)]
+        summary = summarize_usage(usages)
+        self.assertEqual(summary['llm_calls'], 3)
+        self.assertEqual(summary['cache_hits'], 1)
+        self.assertEqual(summary['input_tokens'], 300)
+        self.assertEqual(summary['output_tokens'], 60)
+        self.assertAlmostEqual(summary['latency'], 4.01)
+        self.assertEqual(summary['max_latency'], 2.5)
+        self.assertEqual(summarize_usage([])['llm_calls'], 0)
+
+    def test_read_response(self):
+        response = read_response(make_response('def f(): pass', 10, 5), 'system', 'prompt')
+        self.assertEqual(response['input_tokens'], 10)
+        # The tokens that were not reported are estimated
+        estimated = read_response(make_response('def f(): pass', None, None), 'system', 'prompt' * 10)
+        self.assertEqual(estimated['text'], 'def f(): pass')
+        self.assertEqual(estimated['input_tokens'], 17)
+        self.assertEqual(estimated['output_tokens'], 4)
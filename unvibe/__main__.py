@@ -36,7 +36,7 @@ def main(args) -> (State, str):
     log('Sources:', args.sources)
     log('Tests:', args.tests)
     tests_container = FolderPatternTestsContainer(args.tests, args.pattern)
-    tests_container.generate_test_suite()
+    tests_container.index_tests()  # Imports the tests, and so the @ai entities
     sources = get_sources_context(args)
     best_state = start_search(magic_entities, tests_container, sources, args.display_report)
     output_file = write_output_folder(best_state, args.output_folder)
@@ -0,0 +1,78 @@
+import threading
+import time
+from typing import Optional, List
+
+from unvibe.config import config_section
+from unvibe.usage import Usage
+
+
+class Budget:
+    """
+    Upper bounds on the cost of a search: wall-clock minutes, tokens, LLM calls and test evaluations.
+    Every limit is optional. The search threads report what they spend, and stop when exceeded() is not None.
+    The answers that come from the cache are free: they don't count as LLM calls nor tokens.
+    """
+
+    def __init__(self, max_minutes=None, max_total_tokens=None, max_llm_calls=None, max_evaluations=None):
+        self.max_minutes = max_minutes
+        self.max_total_tokens = max_total_tokens
+        self.max_llm_calls = max_llm_calls
+        self.max_evaluations = max_evaluations
+        self.started_at = time.monotonic()
+        self.total_tokens = 0
+        self.llm_calls = 0
+        self.evaluations = 0
+        self.usages: List[Usage] = []  # ledger of every LLM call, including the cached ones
+        self.lock = threading.Lock()
+
+    def add_llm_call(self, usage: Usage):
+        with self.lock:
+            self.usages.append(usage)
+            if usage.cache_hit:
+                return
+            self.llm_calls += 1
+            self.total_tokens += usage.billed_tokens()
+
+    def add_evaluation(self):
+        with self.lock:
+            self.evaluations += 1
+
+    def minutes(self) -> float:
+        return (time.monotonic() - self.started_at) / 60
+
+    def exceeded(self) -> Optional[str]:
+        """Which limit was reached, or None if the search can go on"""
+        with self.lock:
+            if self.max_minutes is not None and self.minutes() >= self.max_minutes:
+                return f'max_minutes={self.max_minutes}'
+            if self.max_total_tokens is not None and self.total_tokens >= self.max_total_tokens:
+                return f'max_total_tokens={self.max_total_tokens}'
+            if self.max_llm_calls is not None and self.llm_calls >= self.max_llm_calls:
+                return f'max_llm_calls={self.max_llm_calls}'
+            if self.max_evaluations is not None and self.evaluations >= self.max_evaluations:
+                return f'max_evaluations={self.max_evaluations}'
+        return None
+
+    def remaining(self) -> str:
+        """What is left of each limit, for the spinner"""
+        with self.lock:
+            left = []
+            if self.max_minutes is not None:
+                left.append(f'{max(self.max_minutes - self.minutes(), 0):.1f} min')
+            if self.max_total_tokens is not None:
+                left.append(f'{max(self.max_total_tokens - self.total_tokens, 0)} tokens')
+            if self.max_llm_calls is not None:
+                left.append(f'{max(self.max_llm_calls - self.llm_calls, 0)} LLM calls')
+            if self.max_evaluations is not None:
+                left.append(f'{max(self.max_evaluations - self.evaluations, 0)} evaluations')
+        return 'Left: ' + ', '.join(left) if len(left) > 0 else ''
+
+
+def budget_from_config(search_config=None) -> Budget:
+    """The limits of the [search] section, or of search_config"""
+    if search_config is None:
+        search_config = config_section('search')
+    return Budget(max_minutes=search_config.get('max_minutes'),
+                  max_total_tokens=search_config.get('max_total_tokens'),
+                  max_llm_calls=search_config.get('max_llm_calls'),
+                  max_evaluations=search_config.get('max_evaluations'))
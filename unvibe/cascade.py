@@ -0,0 +1,62 @@
+from typing import List, Dict
+
+from unvibe.config import config, config_section
+from unvibe.log import log
+
+# Keys of a [[cascade]] tier that control the cascade, and are not LLM settings
+tier_keys = {'max_depth'}
+
+
+class Cascade:
+    """
+    Ordered tiers of LLM settings, from the cheapest to the strongest. The search starts on the first tier,
+    and moves to the next one when the top score did not improve for `patience` depths, or when the tier
+    spent its own max_depth. The last tier is used until the end of the search.
+    """
+
+    def __init__(self, tiers: List[Dict], patience=2):
+        assert len(tiers) > 0, 'The cascade needs at least one tier'
+        self.tiers = tiers
+        self.patience = patience
+        self.tier = 0
+        self.depths = 0  # on the current tier
+        self.stale_depths = 0  # without improving the top score
+        self.top_score = -1
+
+    def ai_config(self) -> Dict:
+        """The LLM settings of the current tier"""
+        return {k: v for k, v in self.tiers[self.tier].items() if k not in tier_keys}
+
+    def update(self, top_score) -> bool:
+        """Called after each depth of the search, returns whether it moved to the next tier"""
+        self.depths += 1
+        if top_score > self.top_score:
+            self.top_score = top_score
+            self.stale_depths = 0
+        else:
+            self.stale_depths += 1
+        if self.tier == len(self.tiers) - 1:
+            return False
+        max_depth = self.tiers[self.tier].get('max_depth')
+        if self.stale_depths >= self.patience or (max_depth is not None and self.depths >= max_depth):
+            self.tier += 1
+            self.depths = 0
+            self.stale_depths = 0
+            ai_config = self.ai_config()
+            log(f'Top score {self.top_score} is not improving, moving to {ai_config["provider"]} {ai_config["model"]}')
+            return True
+        return False
+
+
+def cascade_from_config(ai_config=None, tiers=None, search_config=None) -> Cascade:
+    """
+    Each [[cascade]] table overrides the settings of [ai]. Without them, [ai] is the only tier.
+    A search of a portfolio passes its own ai_config, tiers and search_config instead.
+    """
+    if ai_config is None:
+        ai_config = config['ai']
+        tiers = config.get('cascade', [])
+    if search_config is None:
+        search_config = config_section('search')
+    tiers = [{**ai_config, **tier} for tier in tiers or []]
+    return Cascade(tiers or [ai_config], patience=search_config.get('cascade_patience', 2))
@@ -38,12 +38,14 @@ def check_config(config):
         sys.exit(1)
 
 
-def config_get_or(section, key, default=None):
+def config_section(section):
     if section not in config:
         raise Exception(f'Section [{section}] not found in {config_file_name}. Please check documentation: {doc_url}')
-    if key in config[section]:
-        return config[section][key]
-    return default
+    return config[section]
+
+
+def config_get_or(section, key, default=None):
+    return config_section(section).get(key, default)
 
 
 config = read_config()
@@ -1,34 +1,77 @@
-import re
-import traceback
-import unittest
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from copy import copy
 from pprint import pprint
-from random import random
-from typing import List, Dict
+from random import Random
+from typing import List, Dict, Tuple
 
 from yaspin import yaspin
 
 from unvibe import magic_entities
-from unvibe.llm import ai_call
-from unvibe.suite import UnvibeTestResult
+from unvibe.budget import Budget, budget_from_config
+from unvibe.cascade import Cascade, cascade_from_config
+from unvibe.evaluator import make_evaluator, run_tests, cleanup_error_str
+from unvibe.fingerprint import fingerprint
+from unvibe.llm import ai_call, implement_re, LLMUnavailable, Cancelled, AnyEvent, preload
 from unvibe.tests_container import TestsContainer
-from unvibe.config import config, config_get_or
+from unvibe.config import config, config_section
 from unvibe.log import log
 from unvibe.magic import cleanup_implementation, MagicEntity
+from unvibe.prescreen import prescreen
 from unvibe.rand import up_to_1
 from unvibe.state import State
 from unvibe.ui import create_page_and_open_browser
+from unvibe.usage import Usage, summarize_usage, format_usage_summary
 
+seen_lock = threading.Lock()
 
-def generate_new_state(count, state: State, temperature: float, tests_container: TestsContainer) -> State:
-    """Generates a new state for program space search"""
+
+def generate_new_states(count, state: State, temperature: float, samples: int, evaluator,
+                        seen: Dict[str, State], budget: Budget, ai_config=None, cancelled=None,
+                        search_config=None) -> List[State]:
+    """
+    Asks the LLM of ai_config for `samples` answers to the prompt of state, and generates a new state for each one,
+    numbered from count. Nothing is generated if the budget ran out, or if the LLM is unavailable.
+    Setting the event cancelled stops the LLM call in progress, and the evaluation of its answers.
+    """
+    if budget.exceeded() is not None or (cancelled is not None and cancelled.is_set()):
+        return []
+    first_error = [state.errors[0]] if len(state.errors) > 0 else []
+    try:
+        prompt, resp_texts, usage = ai_call(state.mes, state.orig_context, state.changed_context(), state.tests,
+                                            first_error, temperature, samples, ai_config, cancelled,
+                                            search_config)
+    except LLMUnavailable as exc:
+        # The search goes on with the other candidates
+        log(exc)
+        return []
+    except Cancelled:
+        return []
+    budget.add_llm_call(usage)
+    new_states = []
+    for i, resp_text in enumerate(resp_texts):
+        new_state = generate_new_state(count + i, state, temperature, prompt, resp_text, usage, evaluator, seen,
+                                       budget, cancelled)
+        if new_state is not None:
+            new_states.append(new_state)
+    return new_states
+
+
+def generate_new_state(count, state: State, temperature: float, prompt: str, resp_text: str, usage: Usage,
+                       evaluator, seen: Dict[str, State], budget: Budget, cancelled=None) -> State:
+    """
+    Generates a new state for program space search, from an answer of the LLM.
+    seen maps the fingerprint of every candidate of the search to its state: if the new candidate is
+    the same code as a known one, it's counted as a duplicate of that state and None is returned.
+    None is also returned if the budget ran out, or the search was cancelled, before the candidate was evaluated.
+    """
     new_state = State()
     new_state.mes = state.mes
+    new_state.orig_context = state.orig_context
     new_state.count = count
     new_state.tests = state.tests
     new_state.temperature = temperature
-    first_error = [state.errors[0]] if len(state.errors) > 0 else []
-    prompt, resp_text = ai_call(state.mes, state.context, state.tests, first_error, temperature)
+    new_state.usage = usage
     new_state.prompt = prompt
     new_state.ai_output = resp_text
     impls = parse_ai_output(resp_text)
@@ -39,17 +82,34 @@ def generate_new_state(count, state: State, temperature: float, tests_container:
 
     if has_all_impls:
         log(f'Received {len(impls)} implementations, expected {len(state.mes)}')
-        for me in new_state.mes:
-            if me.name in impls:
-                cleaned_up = cleanup_implementation(impls[me.name], me.__class__)
-                me.set_impl(cleaned_up)
-            else:
-                raise Exception(f'Expected implementation for {me.name}')
-        new_state.context = new_state.build_context_from_magic_entities()
-        run_tests(tests_container, new_state)
-        # Reset implementations:
-        for me in new_state.mes:
-            me.set_impl(None)
+        cleaned_impls = {me.name: cleanup_implementation(impls[me.name], me.__class__) for me in new_state.mes}
+        # Reject the candidates that can't work without running the tests
+        screen_errors = [error for error in (prescreen(cleaned_impls[me.name], me) for me in new_state.mes)
+                         if error is not None]
+        if len(screen_errors) > 0:
+            log('Rejected before running the tests:', screen_errors)
+            new_state.context = new_state.build_context_from_magic_entities(cleaned_impls)
+            new_state.score = 0
+            new_state.errors = screen_errors
+            return new_state
+        candidate_fingerprint = fingerprint(cleaned_impls)
+        if candidate_fingerprint is not None:
+            with seen_lock:
+                known_state = seen.get(candidate_fingerprint)
+                if known_state is not None:
+                    known_state.duplicates += 1
+                else:
+                    seen[candidate_fingerprint] = new_state
+            if known_state is not None:
+                log(f'Same implementation as #{known_state.count}, not evaluating it again')
+                return None
+        if budget.exceeded() is not None or (cancelled is not None and cancelled.is_set()):
+            return None
+        new_state.context = new_state.build_context_from_magic_entities(cleaned_impls)
+        budget.add_evaluation()
+        outcome = evaluator.evaluate(cleaned_impls, cancelled)
+        for field, value in outcome.items():
+            setattr(new_state, field, value)
     else:
         log('LLM OUTPUT:', resp_text)
         new_state.score = 0
@@ -61,14 +121,17 @@ def generate_new_state(count, state: State, temperature: float, tests_container:
 
 
 def start_search(mes: List[MagicEntity], tests_container: TestsContainer, sources='', display_tree=False):
-    log('Using model', config['ai']['model'])
-
     # Check all magic entities are registered
     for me in mes:
         assert me in magic_entities, f'{me} not registered with @ai'
 
-    # Run the tree search
-    root, states = search(mes, tests_container, sources, display_tree)
+    # Run the tree search, or a portfolio of searches with different settings
+    portfolio = config.get('portfolio', [])
+    if len(portfolio) > 0:
+        root, states = search_portfolio(mes, tests_container, portfolio, sources)
+    else:
+        log('Using model', config['ai']['model'])
+        root, states = search(mes, tests_container, sources, display_tree)
     best_state = states[0]
     if display_tree:
         file = create_page_and_open_browser(root)
@@ -76,22 +139,90 @@ def start_search(mes: List[MagicEntity], tests_container: TestsContainer, source
     return best_state
 
 
-def get_temperatures(depth):
-    random_spread = config_get_or('search', 'random_spread', 2)
+def search_portfolio(mes: List[MagicEntity], tests_container: TestsContainer, portfolio: List[Dict], sources=''):
+    """
+    Runs a search for each [[portfolio]] table at the same time. Each one overrides [ai] and [search] with its
+    own ai and search tables, and can have its own cascade. The searches share the caches and the tests runner,
+    and all of them stop as soon as one finds a perfect score, also in the middle of their tests.
+    Returns the root and states of the best search.
+    """
+    stop = threading.Event()
+    evaluator = make_evaluator(tests_container, mes)  # before any thread is started, it may fork
+    spinner = yaspin()
+    spinner.start()
+    executor = ThreadPoolExecutor(max_workers=len(portfolio))
+    try:
+        futures = []
+        for i, member in enumerate(portfolio):
+            ai_config = {**config['ai'], **member.get('ai', {})}
+            search_config = {**config_section('search'), **member.get('search', {})}
+            name = member.get('name', f'{ai_config["provider"]} {ai_config["model"]}')
+            log(f'Portfolio search {i}: {name}')
+            cascade = cascade_from_config(ai_config, member.get('cascade', []), search_config)
+            futures.append((name, executor.submit(search, mes, tests_container, sources, False, search_config,
+                                                  cascade, evaluator, stop, spinner, f'[{name}] ')))
+        results = [(name, future.result()) for name, future in futures]
+    finally:
+        stop.set()
+        # The stop also cancels the tests still running in the shared evaluator, for the candidates of the
+        # searches that lost: the searches end their running jobs before the evaluator is closed
+        executor.shutdown(wait=True, cancel_futures=True)
+        evaluator.close()
+        spinner.stop()
+    name, (root, states) = max(results, key=lambda result: result[1][1][0].score)
+    print(f'Best search of the portfolio: {name}, score {states[0].score:.2f}')
+    return root, states
+
+
+def get_temperatures(depth, search_config=None, rng: Random = None, drawn=0):
+    """
+    The temperatures to try for a state. rng is the random generator of the search, seeded with [search] seed.
+    drawn is how many temperatures the search took so far, for the "increasing" random_type.
+    With temperature_step, the "uniform" temperatures are picked without repetitions from the multiples of
+    the step: the same temperatures come back across runs, and their answers from the cache.
+    """
+    if search_config is None:
+        search_config = config_section('search')
+    if rng is None:
+        rng = Random()
+    random_spread = search_config.get('random_spread', 2)
     if depth == 0:
-        random_spread = config_get_or('search', 'initial_spread', 10)
-    random_type = config_get_or('search', 'random_type', 'uniform')
-    max_temperature = config_get_or('search', 'max_temperature', 0.7)
+        random_spread = search_config.get('initial_spread', 10)
+    random_type = search_config.get('random_type', 'uniform')
+    max_temperature = search_config.get('max_temperature', 0.7)
+    step = search_config.get('temperature_step')
 
     # Generate a bunch of rand temperatures, but always try temp=0
     if random_type == 'increasing':
-        return [up_to_1.pop(0) for _ in range(random_spread)]
+        return [up_to_1[min(drawn + i, len(up_to_1) - 1)] for i in range(random_spread)]
+    elif random_type == 'uniform' and step:
+        steps = [round(i * step, 2) for i in range(1, int(round(max_temperature / step, 6)) + 1)]
+        if len(steps) == 0:
+            # max_temperature is below the step: only temperature 0 is allowed
+            return [0]
+        picked = rng.sample(steps, min(random_spread, len(steps)))
+        return [0] + picked + rng.choices(steps, k=random_spread - len(picked))
     elif random_type == 'uniform':
-        return [0] + [random() * max_temperature for _ in range(random_spread)]
+        return [0] + [rng.random() * max_temperature for _ in range(random_spread)]
     else:
         raise Exception(f'Unknown random_type "{random_type}". Use either "increasing" or "uniform"')
 
 
+def group_temperatures(temperatures: List[float], samples_per_request: int) -> List[Tuple[float, int]]:
+    """
+    Groups the temperatures in requests of up to samples_per_request answers, as (temperature, samples).
+    Each group is asked at its mean temperature. Temperature 0 is always asked alone: its answers would be the same.
+    """
+    if samples_per_request <= 1:
+        return [(temperature, 1) for temperature in temperatures]
+    requests = [(temperature, 1) for temperature in temperatures if temperature == 0]
+    others = sorted(temperature for temperature in temperatures if temperature != 0)
+    for i in range(0, len(others), samples_per_request):
+        group = others[i:i + samples_per_request]
+        requests.append((sum(group) / len(group), len(group)))
+    return requests
+
+
 def build_initial_context(mes, sources):
     if len(sources) > 0:
         # We have a list of source files, so we replace each MagicEntity with its implementation
@@ -114,9 +245,21 @@ def build_initial_context(mes, sources):
         return new_context
 
 
-def search(mes: List[MagicEntity], test_container: TestsContainer, sources='', display_tree=False):
-    take_best_n = config_get_or('search', 'take_best_n', 3)
-    max_depth = config_get_or('search', 'max_depth', 10)
+def search(mes: List[MagicEntity], test_container: TestsContainer, sources='', display_tree=False,
+           search_config=None, cascade: Cascade = None, evaluator=None, stop: threading.Event = None, spinner=None,
+           label=''):
+    """
+    The tree search. The settings are those of [search] and of the cascade, unless given.
+    A portfolio of searches shares the evaluator, the spinner and the stop event: setting it stops the search.
+    """
+    if search_config is None:
+        search_config = config_section('search')
+    take_best_n = search_config.get('take_best_n', 3)
+    max_depth = search_config.get('max_depth', 10)
+    concurrency = search_config.get('concurrency', 1)
+    samples_per_request = search_config.get('samples_per_request', 1)
+    # The same seed gives the same temperatures and choices, so a re-run is served by the cache
+    rng = Random(search_config.get('seed'))
 
     # Generate the root state
     root = State()
@@ -132,121 +275,108 @@ def search(mes: List[MagicEntity], test_container: TestsContainer, sources='', d
     states = [root]
 
     found = False
+    stop_reason = None
+    budget = budget_from_config(search_config)
+    if cascade is None:
+        cascade = cascade_from_config(search_config=search_config)
     count = 0
-    spinner = yaspin()
-    spinner.start()
+    drawn = 0  # temperatures taken so far
+    seen = {}  # fingerprint -> state, to skip the duplicate candidates
+    owns_evaluator, owns_spinner = evaluator is None, spinner is None
+    if owns_evaluator:
+        evaluator = make_evaluator(test_container, mes)  # before any thread is started, it may fork
+    if owns_spinner:
+        spinner = yaspin()
+        spinner.start()
+    if stop is None:
+        stop = threading.Event()
+    # Set when this search quits early: it cancels the LLM calls still running, like the stop of a portfolio
+    ended = threading.Event()
+    cancelled = AnyEvent(stop, ended)
+    preload(cascade.ai_config())
     top_score = -1
-    for depth in range(max_depth):
-        log('Depth', depth)
-        new_states = []
-        # For each state, generate a bunch of new states feeding back the current test errors
-        for state in states:
-            # Generate a bunch of new states: generate code with LLMs and run the tests to get the score
-            for temp in get_temperatures(depth):
-                log('=============================')
-                log('Temperature', temp)
-                count += 1
-                new_state = generate_new_state(count, state, temp, test_container)
-                if new_state is None:
-                    continue
-                state.children.append(new_state)
-                new_states.append(new_state)
-                if new_state.score > top_score:
-                    top_score = new_state.score
-                    spinner.text = f'Depth {depth}, Top score: {top_score:.2f}'
-                if new_state.score == 1:
-                    # Early quit
+    # All the siblings of a depth are submitted at once, and the LLM calls run concurrently
+    executor = ThreadPoolExecutor(max_workers=concurrency)
+    try:
+        for depth in range(max_depth):
+            stop_reason = budget.exceeded()
+            if stop_reason is not None or stop.is_set():
+                break
+            log('Depth', depth)
+            new_states = []
+            # For each state, generate a bunch of new states feeding back the current test errors
+            jobs = []
+            for state in states:
+                # Generate a bunch of new states: generate code with LLMs and run the tests to get the score
+                temperatures = get_temperatures(depth, search_config, rng, drawn)
+                drawn += len(temperatures)
+                for temp, samples in group_temperatures(temperatures, samples_per_request):
+                    log('=============================')
+                    log('Temperature', temp, 'Samples', samples)
+                    future = executor.submit(generate_new_states, count + 1, state, temp, samples, evaluator, seen,
+                                             budget, cascade.ai_config(), cancelled, search_config)
+                    count += samples
+                    jobs.append((state, future))
+            for future in as_completed([future for _, future in jobs]):
+                for new_state in future.result():
+                    top_score = max(top_score, new_state.score)
+                    found = found or new_state.score == 1
+                spinner.text = f'{label}Depth {depth}, Top score: {top_score:.2f} {budget.remaining()}'
+                if found:
                     log('Found perfect score')
-                    found = True
+                    stop.set()
+                else:
+                    stop_reason = budget.exceeded()
+                if stop.is_set() or stop_reason is not None:
+                    # Early quit: drop the requests that did not start yet, and cancel the running ones
+                    ended.set()
+                    for _, pending in jobs:
+                        pending.cancel()
                     break
-            if found: break
-        states = states + new_states
-        states = sorted(states, key=lambda s: random())
-        states.sort(key=lambda s: s.score, reverse=True)
-        top_score = states[0].score
-        log('Scores   ', [s for s in states], 'Picking the best', take_best_n)
-        states = states[:take_best_n]
-        # log('Selected ', [s for s in states])
-        if display_tree:
-            create_page_and_open_browser(root)
-        if found: break
-    spinner.stop()
-    return root, states
-
-
-def run_tests(tests_container: TestsContainer, new_state: State):
-    """Runs the tests and saves the score/assertions info/errors in the new_state"""
-    test_suite = tests_container.generate_test_suite()
-    runner = unittest.TextTestRunner(resultclass=UnvibeTestResult)
-    result: UnvibeTestResult = runner.run(test_suite)
-    if result.testsRun == 0:
-        raise Exception(f"Test class {test_suite} has no tests.")
-    errors_count = len(result.failures) + len(result.errors)
-    try:
-        if not result.unvibe_test_case:
-            raise Exception('Not using unvibe.TestCase')
-        log('Using unvibe.TestCase')
-        total_assertions = tests_container.count_assertions()
-        log(f"Total assertions: {total_assertions}, Passed: {result.ass_passed}, "
-            f"Executed: {result.ass_executed}, Failed: {result.ass_failed}")
-        if total_assertions == 0:
-            raise Exception('Invalid assertions count')
-        score = result.ass_passed / max(total_assertions, result.ass_executed)
-        tot_executed, tot_passed, tot_failed = result.ass_executed, result.ass_passed, result.ass_failed
-    except Exception as exc:
-        log(exc)
-        score = 1 - errors_count / result.testsRun
-        tot_passed, tot_executed, total_assertions, tot_failed = None, None, None, None
-    log(f'Score: {score}')
-    error_strings = []
-    for test_suite, error_str in result.errors + result.failures:
-        cleaned_up = cleanup_error_str(error_str)
-        error_strings.append(cleaned_up)
-        log(cleaned_up)
-    new_state.passed_assertions = tot_passed
-    new_state.executed_assertions = tot_executed
-    new_state.failed_assertions = tot_failed
-    new_state.total_assertions = total_assertions
-    new_state.errors = error_strings
-    new_state.score = score
-
-
-def remove_lines_with(lines, is_target, minus=1, plus=2):
-    try:
-        target_line = -1
-        for i, line in enumerate(lines):
-            if is_target(line):
-                target_line = i
+            # Collect the results in submission order, so the tree doesn't depend on which call returned first
+            for state, future in jobs:
+                if not future.done() or future.cancelled():
+                    continue
+                state.children.extend(future.result())
+                new_states.extend(future.result())
+            states = states + new_states
+            states = sorted(states, key=lambda s: rng.random())
+            states.sort(key=lambda s: s.score, reverse=True)
+            top_score = states[0].score
+            log('Scores   ', [s for s in states], 'Picking the best', take_best_n)
+            states = states[:take_best_n]
+            if cascade.update(top_score):
+                preload(cascade.ai_config())
+            # log('Selected ', [s for s in states])
+            root.usage_summary = summarize_usage(budget.usages)
+            if display_tree:
+                create_page_and_open_browser(root)
+            if stop.is_set() or stop_reason is not None:
                 break
-        if target_line >= 0:
-            # Remove the target line and those before and after:
-            lines = lines[:target_line - minus] + lines[target_line + plus:]
-        return lines
-    except Exception as e:
-        traceback.print_exc()
-        return lines
-
-
-def cleanup_error_str(error_str):
-    # Remove every reference to the file path:
-    error_str = re.sub(r'File ".*", line', 'line', error_str)
-    # Find the line with "eval" and "self.func_name":
-    lines = error_str.split('\n')
-
-    lines = remove_lines_with(lines, lambda line: 'eval(' in line and '{self.func_name}' in line)
-    lines = remove_lines_with(lines, lambda line: 'exec(code)' in line)
-    lines = remove_lines_with(lines, lambda line: 'return ___eval(' in line)
-    lines = remove_lines_with(lines, lambda line: 'line ' in line and 'in wrapper' in line, minus=0, plus=2)
-    lines = remove_lines_with(lines, lambda line: 'line ' in line and 'in wrapper' in line, minus=0, plus=2)
-
-    # Put back together the redacted lines
-    error_str = '\n'.join(lines)
-    return error_str
+    finally:
+        # Also when the search fails, or the user stops it: the spinner thread would keep the process alive.
+        # The running jobs see the cancel at their next streamed chunk, or while their tests run in a worker:
+        # the evaluator is closed after they end
+        ended.set()
+        executor.shutdown(wait=True, cancel_futures=True)
+        if owns_evaluator:
+            evaluator.close()
+        if owns_spinner:
+            spinner.stop()
+    if stop_reason is not None:
+        print(f'{label}Stopped the search: reached {stop_reason}, returning the best state found so far')
+    elif stop.is_set() and not found:
+        log(f'{label}Stopped the search: another search found a perfect score')
+    root.usage_summary = summarize_usage(budget.usages)
+    print(label + format_usage_summary(root.usage_summary))
+    duplicates = sum(s.duplicates for s in seen.values())
+    log(f'{count} candidates generated, {duplicates} were duplicates of other candidates')
+    return root, states
 
 
 def parse_ai_output(t: str) -> Dict:
     # find anything between <implements name="..."> and </implement>
-    found = re.findall(r'<implement name="(.+?)">(.*?)</implement>', t, re.DOTALL)
+    found = implement_re.findall(t)
     found_dict = dict(found)
     return found_dict
 
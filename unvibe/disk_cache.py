@@ -1,54 +1,243 @@
+import hashlib
+import json
 import os
 import pickle
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
 
 from unvibe.config import config_get_or
 
-cache_file = 'unvibe_cache.pkl'
-
-
-def disk_cached(func):
+cache_file = 'unvibe_cache.db'
+legacy_cache_file = 'unvibe_cache.pkl'  # Whole-dict pickle used by older versions, retired on first use
+busy_timeout = 30  # Seconds to wait for the write lock held by another process
+
+# sqlite3 connections can't be shared between threads, so every thread opens its own.
+# local.hit tells if the last call to a disk_cached function in this thread was answered by the cache.
+local = threading.local()
+
+# In-process LRU tier in front of the disk: key -> value
+memory_cache = OrderedDict()
+memory_lock = threading.Lock()
+# The hits of the memory tier, not written to disk yet: key -> accessed_at.
+# Without them the hottest entries would look the oldest to the eviction of the disk tier
+touched = {}
+touched_batch = 64
+
+columns = {
+    'prompt': 'TEXT',
+    'size': 'INTEGER',  # bytes of value and prompt, to enforce cache_max_mb
+    'created_at': 'REAL',  # to enforce cache_ttl_days
+    'accessed_at': 'REAL',  # to evict the least recently used entries first
+}
+
+
+@contextmanager
+def write_transaction(conn):
+    """
+    BEGIN IMMEDIATE takes the write lock up front, so that concurrent processes sharing the cache
+    serialize their writes instead of failing halfway through a transaction.
+    """
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        yield conn
+    except BaseException:
+        conn.execute('ROLLBACK')
+        raise
+    conn.execute('COMMIT')
+
+
+def connect():
+    conn = getattr(local, 'conn', None)
+    # A connection can't be used in a child process forked after it was opened
+    if conn is not None and local.cache_file == cache_file and local.pid == os.getpid():
+        return conn
+    # Autocommit mode: transactions are explicit, see write_transaction()
+    conn = sqlite3.connect(cache_file, timeout=busy_timeout, isolation_level=None)
+    # WAL lets many processes read while one writes, and a crash never leaves a truncated cache
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    with write_transaction(conn):
+        conn.execute('CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value BLOB NOT NULL)')
+        # Add the columns missing from caches written by older versions
+        existing_columns = [row[1] for row in conn.execute('PRAGMA table_info(cache)')]
+        for column, column_type in columns.items():
+            if column not in existing_columns:
+                conn.execute(f'ALTER TABLE cache ADD COLUMN {column} {column_type}')
+        conn.execute('UPDATE cache SET size = length(value) + coalesce(length(prompt), 0), created_at = ?, '
+                     'accessed_at = ? WHERE size IS NULL', (time.time(), time.time()))
+        conn.execute('CREATE INDEX IF NOT EXISTS cache_created_at ON cache (created_at)')
+        conn.execute('CREATE INDEX IF NOT EXISTS cache_accessed_at ON cache (accessed_at)')
+        retire_legacy_cache()
+    local.conn = conn
+    local.cache_file = cache_file
+    local.pid = os.getpid()
+    return conn
+
+
+def retire_legacy_cache():
+    """
+    The old pickle cache is keyed on the whole prompt of the old calls: no lookup can produce those keys,
+    so its entries are not imported. It's renamed, so that it can be deleted, and reported only once.
+    Runs inside the write transaction of connect(), so only one process does it.
+    """
+    if not os.path.exists(legacy_cache_file):
+        return
+    os.replace(legacy_cache_file, legacy_cache_file + '.unused')
+    print(f'{legacy_cache_file} was written by an older version and can\'t be reused: renamed it to '
+          f'{legacy_cache_file}.unused, you can delete it')
+
+
+def normalize_text(text: str) -> str:
+    """Canonical form of a prompt: trailing spaces and blank lines don't change the cache key"""
+    lines = [line.rstrip() for line in text.strip().split('\n')]
+    return '\n'.join([line for line in lines if line != ''])
+
+
+def cache_key(*parts) -> str:
+    """Fixed-size digest of the parts, whatever the size of the prompts"""
+    canonical = json.dumps(parts, default=repr)
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+def default_key_func(func):
+    def key_func(*args, **kwargs):
+        return cache_key(func.__name__, repr(args), repr(kwargs)), None
+
+    return key_func
+
+
+def remember(key, value):
+    memory_entries = config_get_or('search', 'cache_memory_entries', 256)
+    with memory_lock:
+        memory_cache[key] = value
+        memory_cache.move_to_end(key)
+        while len(memory_cache) > memory_entries:
+            memory_cache.popitem(last=False)
+
+
+def flush_touched(conn):
+    """Writes the access times of the memory hits to disk"""
+    with memory_lock:
+        rows = [(accessed_at, key) for key, accessed_at in touched.items()]
+        touched.clear()
+    conn.executemany('UPDATE cache SET accessed_at = ? WHERE key = ?', rows)
+
+
+def lookup(key):
+    """Returns (True, value) if the key is in the cache, (False, None) otherwise"""
+    with memory_lock:
+        found = key in memory_cache
+        if found:
+            memory_cache.move_to_end(key)
+            value = memory_cache[key]
+            touched[key] = time.time()
+            flush = len(touched) >= touched_batch
+    if found:
+        if flush:
+            flush_touched(connect())
+        return True, value
+    conn = connect()
+    row = conn.execute('SELECT value, created_at FROM cache WHERE key = ?', (key,)).fetchone()
+    if row is None:
+        return False, None
+    ttl_days = config_get_or('search', 'cache_ttl_days', None)
+    now = time.time()
+    if ttl_days is not None and row[1] < now - ttl_days * 24 * 3600:
+        return False, None  # Expired, it will be replaced by the next store()
+    conn.execute('UPDATE cache SET accessed_at = ? WHERE key = ?', (now, key))
+    value = pickle.loads(row[0])
+    remember(key, value)
+    return True, value
+
+
+def store(key, value, prompt=None):
+    blob = pickle.dumps(value)
+    size = len(blob) + (len(prompt) if prompt is not None else 0)
+    now = time.time()
+    conn = connect()
+    with write_transaction(conn):
+        conn.execute('INSERT OR REPLACE INTO cache (key, value, prompt, size, created_at, accessed_at) '
+                     'VALUES (?, ?, ?, ?, ?, ?)', (key, blob, prompt, size, now, now))
+        # The eviction must see the entries used from memory as recent
+        flush_touched(conn)
+        evict(conn, now)
+    remember(key, value)
+
+
+def used_bytes(conn) -> int:
+    """Size of the live pages of the database, without scanning the table"""
+    page_size = conn.execute('PRAGMA page_size').fetchone()[0]
+    page_count = conn.execute('PRAGMA page_count').fetchone()[0]
+    freelist_count = conn.execute('PRAGMA freelist_count').fetchone()[0]
+    return (page_count - freelist_count) * page_size
+
+
+def evict(conn, now):
+    """Drops the entries older than cache_ttl_days, then the least recently used ones above cache_max_mb"""
+    ttl_days = config_get_or('search', 'cache_ttl_days', None)
+    if ttl_days is not None:
+        conn.execute('DELETE FROM cache WHERE created_at < ?', (now - ttl_days * 24 * 3600,))
+    max_mb = config_get_or('search', 'cache_max_mb', None)
+    if max_mb is None:
+        return
+    max_bytes = max_mb * 1024 * 1024
+    excess = used_bytes(conn) - max_bytes
+    if excess <= 0:
+        return
+    evicted, freed = [], 0
+    for key, size in conn.execute('SELECT key, size FROM cache ORDER BY accessed_at'):
+        if freed >= excess:
+            break
+        evicted.append((key,))
+        freed += size
+    conn.executemany('DELETE FROM cache WHERE key = ?', evicted)
+
+
+def disk_cached(func=None, key_func=None):
+    """
+    Caches the results of func on disk. key_func(*args, **kwargs) returns the key of the call and
+    the raw prompt that is stored beside the value for debugging (or None).
+    """
+    if func is None:
+        return lambda f: disk_cached(f, key_func)
     if config_get_or('search', 'cache', True) is False:
         return func
+    if key_func is None:
+        key_func = default_key_func(func)
 
     def wrapper(*args, **kwargs):
-        key = f"{func.__name__}_{args}_{kwargs}"
-
-        # Create cache file if it doesn't exist
-        if not os.path.exists(cache_file):
-            with open(cache_file, 'wb') as f:
-                pickle.dump({}, f)
-
-        # Read existing cache
-        with open(cache_file, 'rb') as f:
-            cache = pickle.load(f)
+        key, prompt = key_func(*args, **kwargs)
 
         # Check if result is cached
-        if key in cache:
-            return cache[key]
+        found, result = lookup(key)
+        local.hit = found
+        if found:
+            return result
 
-        # Compute result
+        # Compute result and store only the new entry
         result = func(*args, **kwargs)
-
-        # Store result in cache
-        cache[key] = result
-        with open(cache_file, 'wb') as f:
-            pickle.dump(cache, f)
-
+        store(key, result, prompt)
         return result
 
     return wrapper
 
 
-def reset_cache():
-    if os.path.exists(cache_file):
-        os.remove(cache_file)
+def last_call_was_cached() -> bool:
+    return getattr(local, 'hit', False)
 
 
-def get_keys():
-    if not os.path.exists(cache_file):
-        return set()
+def reset_cache():
+    conn = connect()
+    with write_transaction(conn):
+        conn.execute('DELETE FROM cache')
+    with memory_lock:
+        memory_cache.clear()
+        touched.clear()
 
-    with open(cache_file, 'rb') as f:
-        cache = pickle.load(f)
 
-    return set(cache.keys())
+def get_keys():
+    rows = connect().execute('SELECT key FROM cache').fetchall()
+    return set(row[0] for row in rows)
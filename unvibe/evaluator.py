@@ -0,0 +1,337 @@
+import multiprocessing
+import queue
+import re
+import signal
+import threading
+import time
+import traceback
+import unittest
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from typing import Dict, List
+
+from unvibe.config import config_get_or
+from unvibe.disk_cache import cache_key, normalize_text, lookup, store
+from unvibe.log import log
+from unvibe.magic import MagicEntity
+from unvibe.state import State
+from unvibe.suite import UnvibeTestResult
+from unvibe.tests_container import TestsContainer
+
+# What an evaluation saves in the State of a candidate
+outcome_fields = ['score', 'passed_assertions', 'executed_assertions', 'failed_assertions', 'total_assertions',
+                  'errors']
+
+# The magic entities of this process are shared by every evaluation: only one candidate
+# at a time can be installed on them.
+install_lock = threading.Lock()
+
+# Outcomes of the candidates already evaluated in this process: outcome_key() -> outcome
+outcomes = {}
+outcomes_lock = threading.Lock()
+
+
+def evaluate_impls(tests_container: TestsContainer, mes: List[MagicEntity], impls: Dict[str, str],
+                   test_suite=None) -> Dict:
+    """Installs the implementations (name -> source code) on the magic entities and runs the tests"""
+    state = State()
+    try:
+        for me in mes:
+            me.set_impl(impls[me.name])
+        run_tests(tests_container, state, test_suite)
+    finally:
+        # Reset implementations:
+        for me in mes:
+            me.set_impl(None)
+    return {field: getattr(state, field) for field in outcome_fields}
+
+
+class InProcessEvaluator:
+    """Runs the tests of each candidate in the search process, one after another."""
+
+    def __init__(self, tests_container: TestsContainer, mes: List[MagicEntity]):
+        self.tests_container = tests_container
+        self.mes = mes
+        self.limits = None  # the tests run without time and memory limits
+
+    def evaluate(self, impls: Dict[str, str], cancelled=None) -> Dict:
+        # The tests run in this thread, and can't be stopped once started
+        with install_lock:
+            return evaluate_impls(self.tests_container, self.mes, impls)
+
+    def close(self):
+        pass
+
+
+# Set in each worker process by init_worker()
+worker_tests_container: TestsContainer = None
+worker_mes: List[MagicEntity] = None
+worker_test_suite = None
+worker_cancel_flags = None
+
+# Evaluations that can run, or wait for a worker, at the same time: each one has its own cancel flag
+cancel_slots = 256
+
+# How often a waiting evaluation checks whether it was cancelled, in seconds
+poll_interval = 0.1
+
+
+def init_worker(tests_container, mes, cancel_flags):
+    """
+    Warms up the worker: the test modules and their dependencies are imported, and the tests are
+    discovered, only once. Every candidate runs in a fork of the worker, with its own copy of the suite.
+    """
+    global worker_tests_container, worker_mes, worker_test_suite, worker_cancel_flags
+    worker_tests_container = tests_container
+    worker_mes = mes
+    worker_cancel_flags = cancel_flags
+    worker_test_suite = tests_container.generate_test_suite()
+
+
+def failed_outcome(error: str) -> Dict:
+    """
+    The outcome of a candidate stopped by the resource guards. It depends on the load of the machine and on the
+    limits too, not only on the code: it's marked as resource_guard, so that it's not memoized.
+    """
+    return {'score': 0, 'passed_assertions': 0, 'executed_assertions': 0, 'failed_assertions': 0,
+            'total_assertions': 0, 'errors': [error], 'resource_guard': True}
+
+
+def set_resource_limits(cpu_seconds, memory_mb):
+    import resource  # Unix only, like fork
+    if cpu_seconds is not None:
+        # SIGXCPU kills the process at the soft limit
+        resource.setrlimit(resource.RLIMIT_CPU, (cpu_seconds, cpu_seconds + 1))
+    if memory_mb is not None:
+        # Allocations above the limit raise MemoryError, that the tests report as an error
+        memory_bytes = memory_mb * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (memory_bytes, memory_bytes))
+
+
+def evaluate_in_child(conn, impls, limits):
+    set_resource_limits(limits['cpu_seconds'], limits['memory_mb'])
+    conn.send(evaluate_impls(worker_tests_container, worker_mes, impls, worker_test_suite))
+    conn.close()
+
+
+def evaluate_in_worker(impls: Dict[str, str], limits: Dict, slot: int) -> Dict:
+    """
+    Runs the candidate in a child forked from the worker, so that an infinite loop or a runaway
+    allocation kills only the child, and the worker can score the candidate as failed.
+    The child is killed as soon as the search raises the cancel flag of the slot.
+    """
+    if worker_cancel_flags[slot]:
+        return failed_outcome('The evaluation was cancelled.')
+    context = multiprocessing.get_context('fork')
+    receiver, sender = context.Pipe(duplex=False)
+    child = context.Process(target=evaluate_in_child, args=(sender, impls, limits))
+    child.start()
+    sender.close()
+    timeout = limits['timeout']
+    deadline = time.monotonic() + timeout
+    try:
+        while not receiver.poll(max(0, min(poll_interval, deadline - time.monotonic()))):
+            if worker_cancel_flags[slot]:
+                return failed_outcome('The evaluation was cancelled.')
+            if time.monotonic() >= deadline:
+                return failed_outcome(f'The tests timed out after {timeout}s. Is there an infinite loop?')
+        return receiver.recv()
+    except EOFError:
+        # The child died before sending the outcome
+        child.join()
+        if child.exitcode == -signal.SIGXCPU:
+            return failed_outcome(f'The tests exceeded the CPU time limit of {limits["cpu_seconds"]}s.')
+        return failed_outcome(f'The tests crashed with exit code {child.exitcode}.')
+    finally:
+        receiver.close()
+        if child.is_alive():
+            child.kill()
+        child.join()
+
+
+class ProcessPoolEvaluator:
+    """
+    Runs the tests of the candidates in a pool of worker processes. Only the implementations
+    are sent to the workers: the workers are forked, so they inherit the tests container and the
+    magic entities, which can't be pickled when they are defined inside a function.
+    Every candidate runs in its own child of a worker, with the wall-clock, CPU and memory limits.
+    The cancel flags are in shared memory, inherited by the workers: the threading events of the search
+    can't cross the process boundary.
+    """
+
+    def __init__(self, tests_container: TestsContainer, mes: List[MagicEntity], workers: int, limits: Dict):
+        self.limits = limits
+        context = multiprocessing.get_context('fork')
+        self.cancel_flags = context.RawArray('b', cancel_slots)
+        self.free_slots = queue.Queue()
+        for slot in range(cancel_slots):
+            self.free_slots.put(slot)
+        self.pool = ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=init_worker,
+                                        initargs=(tests_container, mes, self.cancel_flags))
+        # The workers are forked on the first submit: do it now, before the search starts its threads
+        self.pool.submit(int).result()
+
+    def evaluate(self, impls: Dict[str, str], cancelled=None) -> Dict:
+        slot = self.free_slots.get()
+        self.cancel_flags[slot] = 0
+        try:
+            future = self.pool.submit(evaluate_in_worker, impls, self.limits, slot)
+            while True:
+                try:
+                    return future.result(timeout=poll_interval)
+                except TimeoutError:
+                    if cancelled is not None and cancelled.is_set():
+                        # Still waiting for a worker: it never starts. Already running: the worker kills it.
+                        future.cancel()
+                        self.cancel_flags[slot] = 1
+                        if future.cancelled():
+                            return failed_outcome('The evaluation was cancelled.')
+        finally:
+            self.free_slots.put(slot)
+
+    def close(self):
+        # Stops the evaluations still running, and waits for the workers to exit
+        for slot in range(cancel_slots):
+            self.cancel_flags[slot] = 1
+        self.pool.shutdown(wait=True, cancel_futures=True)
+
+
+def outcome_key(tests_source: str, impls: Dict[str, str], limits: Dict = None) -> str:
+    """The limits are part of the key: e.g. a MemoryError may go away with a higher test_memory_mb"""
+    normalized_impls = [(name, normalize_text(impl)) for name, impl in sorted(impls.items())]
+    return cache_key('outcome', normalize_text(tests_source), normalized_impls, sorted((limits or {}).items()))
+
+
+class MemoizedEvaluator:
+    """
+    Returns the outcome of a candidate already evaluated against the same tests without running them again.
+    The LLM often returns the same implementations, up to whitespace, for different siblings.
+    With persist, the outcomes are also saved in the disk cache, and reused across runs.
+    The outcomes of the candidates stopped by the resource guards are not reused: the next run may have
+    more time, or a less loaded machine.
+    """
+
+    def __init__(self, evaluator, tests_source: str, persist: bool):
+        self.evaluator = evaluator
+        self.tests_source = tests_source
+        self.persist = persist
+
+    def evaluate(self, impls: Dict[str, str], cancelled=None) -> Dict:
+        key = outcome_key(self.tests_source, impls, self.evaluator.limits)
+        with outcomes_lock:
+            found = key in outcomes
+            outcome = outcomes.get(key)
+        if not found and self.persist:
+            found, outcome = lookup(key)
+        if found:
+            log('Candidate already evaluated, score:', outcome['score'])
+        else:
+            outcome = self.evaluator.evaluate(impls, cancelled)
+            if outcome.get('resource_guard'):
+                return {field: outcome[field] for field in outcome_fields}
+            if self.persist:
+                store(key, outcome)
+        with outcomes_lock:
+            outcomes[key] = outcome
+        return dict(outcome, errors=list(outcome['errors']))
+
+    def close(self):
+        self.evaluator.close()
+
+
+def make_evaluator(tests_container: TestsContainer, mes: List[MagicEntity]):
+    evaluator = make_tests_runner(tests_container, mes)
+    persist = config_get_or('search', 'cache_test_results', False)
+    return MemoizedEvaluator(evaluator, tests_container.get_source(), persist)
+
+
+def make_tests_runner(tests_container: TestsContainer, mes: List[MagicEntity]):
+    workers = config_get_or('search', 'test_workers', 1)
+    if workers > 0 and 'fork' not in multiprocessing.get_all_start_methods():
+        log('test_workers requires the "fork" start method, running the tests in the search process '
+            'without time and memory limits')
+        workers = 0
+    if workers == 0:
+        return InProcessEvaluator(tests_container, mes)
+    limits = {
+        'timeout': config_get_or('search', 'test_timeout', 60),
+        'cpu_seconds': config_get_or('search', 'test_cpu_seconds', None),
+        'memory_mb': config_get_or('search', 'test_memory_mb', None),
+    }
+    return ProcessPoolEvaluator(tests_container, mes, workers, limits)
+
+
+def run_tests(tests_container: TestsContainer, new_state: State, test_suite=None):
+    """
+    Runs the tests and saves the score/assertions info/errors in the new_state.
+    test_suite is a suite already generated by the tests_container, that can be run only once.
+    """
+    if test_suite is None:
+        test_suite = tests_container.generate_test_suite()
+    runner = unittest.TextTestRunner(resultclass=UnvibeTestResult)
+    result: UnvibeTestResult = runner.run(test_suite)
+    if result.testsRun == 0:
+        raise Exception(f"Test class {test_suite} has no tests.")
+    errors_count = len(result.failures) + len(result.errors)
+    try:
+        if not result.unvibe_test_case:
+            raise Exception('Not using unvibe.TestCase')
+        log('Using unvibe.TestCase')
+        total_assertions = tests_container.count_assertions()
+        log(f"Total assertions: {total_assertions}, Passed: {result.ass_passed}, "
+            f"Executed: {result.ass_executed}, Failed: {result.ass_failed}")
+        if total_assertions == 0:
+            raise Exception('Invalid assertions count')
+        score = result.ass_passed / max(total_assertions, result.ass_executed)
+        tot_executed, tot_passed, tot_failed = result.ass_executed, result.ass_passed, result.ass_failed
+    except Exception as exc:
+        log(exc)
+        score = 1 - errors_count / result.testsRun
+        tot_passed, tot_executed, total_assertions, tot_failed = None, None, None, None
+    log(f'Score: {score}')
+    error_strings = []
+    for test_suite, error_str in result.errors + result.failures:
+        cleaned_up = cleanup_error_str(error_str)
+        error_strings.append(cleaned_up)
+        log(cleaned_up)
+    new_state.passed_assertions = tot_passed
+    new_state.executed_assertions = tot_executed
+    new_state.failed_assertions = tot_failed
+    new_state.total_assertions = total_assertions
+    new_state.errors = error_strings
+    new_state.score = score
+
+
+def remove_lines_with(lines, is_target, minus=1, plus=2):
+    try:
+        target_line = -1
+        for i, line in enumerate(lines):
+            if is_target(line):
+                target_line = i
+                break
+        if target_line >= 0:
+            # Remove the target line and those before and after:
+            lines = lines[:target_line - minus] + lines[target_line + plus:]
+        return lines
+    except Exception as e:
+        traceback.print_exc()
+        return lines
+
+
+def cleanup_error_str(error_str):
+    # Remove every reference to the file path:
+    error_str = re.sub(r'File ".*", line', 'line', error_str)
+    # Find the line with "eval" and "self.func_name":
+    lines = error_str.split('\n')
+
+    lines = remove_lines_with(lines, lambda line: 'eval(' in line and '{self.func_name}' in line)
+    lines = remove_lines_with(lines, lambda line: 'exec(code)' in line)
+    lines = remove_lines_with(lines, lambda line: 'return ___eval(' in line)
+    lines = remove_lines_with(lines, lambda line: 'return self._impl_obj(' in line)
+    lines = remove_lines_with(lines, lambda line: 'raise exc.with_traceback(' in line)
+    lines = remove_lines_with(lines, lambda line: 'exec(compile(impl' in line, minus=0, plus=1)
+    lines = remove_lines_with(lines, lambda line: 'line ' in line and 'in wrapper' in line, minus=0, plus=2)
+    lines = remove_lines_with(lines, lambda line: 'line ' in line and 'in wrapper' in line, minus=0, plus=2)
+
+    # Put back together the redacted lines
+    error_str = '\n'.join(lines)
+    return error_str
@@ -0,0 +1,121 @@
+import ast
+from typing import Dict, Optional
+
+from unvibe.disk_cache import cache_key
+
+
+def strip_docstring(node):
+    body = node.body
+    if body and isinstance(body[0], ast.Expr) and isinstance(body[0].value, ast.Constant) \
+            and isinstance(body[0].value.value, str):
+        node.body = body[1:] or [ast.Pass()]
+
+
+def iter_scope(node):
+    """The nodes of a function body, in source order, without entering nested functions, lambdas and classes"""
+    for child in ast.iter_child_nodes(node):
+        yield child
+        if not isinstance(child, (ast.FunctionDef, ast.AsyncFunctionDef, ast.Lambda, ast.ClassDef)):
+            yield from iter_scope(child)
+
+
+def parameter_names(node) -> list:
+    args = node.args
+    return [a.arg for a in args.posonlyargs + args.args + [args.vararg] + args.kwonlyargs + [args.kwarg]
+            if a is not None]
+
+
+def local_names(node) -> list:
+    """
+    Names assigned in the function, in order of first appearance. The parameters are not included: their names
+    are part of the API of the function, e.g. f(x, reverse=True) and f(x, descending=True) are different.
+    """
+    names = []
+    declared = set(parameter_names(node))
+    for child in iter_scope(node):
+        if isinstance(child, ast.Name) and isinstance(child.ctx, (ast.Store, ast.Del)):
+            names.append(child.id)
+        elif isinstance(child, ast.ExceptHandler) and child.name is not None:
+            names.append(child.name)
+        elif isinstance(child, (ast.Global, ast.Nonlocal)):
+            declared.update(child.names)
+    ordered = []
+    for name in names:
+        if name not in ordered and name not in declared:
+            ordered.append(name)
+    return ordered
+
+
+class Normalizer(ast.NodeTransformer):
+    """Strips the docstrings and renames the local names of every function to v<depth>_<index>, except parameters"""
+
+    def __init__(self):
+        self.scopes = [{}]
+
+    def visit_scope(self, node):
+        renames = dict(self.scopes[-1])
+        # A parameter shadows the local of the enclosing function with the same name
+        for name in parameter_names(node):
+            renames.pop(name, None)
+        for i, name in enumerate(local_names(node)):
+            renames[name] = f'v{len(self.scopes)}_{i}'
+        self.scopes.append(renames)
+        node.args = self.visit(node.args)
+        if isinstance(node.body, list):
+            node.body = [self.visit(child) for child in node.body]
+        else:
+            node.body = self.visit(node.body)
+        self.scopes.pop()
+        return node
+
+    def visit_FunctionDef(self, node):
+        strip_docstring(node)
+        # Decorators and defaults are evaluated in the enclosing scope. Annotations are dropped
+        node.decorator_list = [self.visit(d) for d in node.decorator_list]
+        node.args.defaults = [self.visit(d) for d in node.args.defaults]
+        node.args.kw_defaults = [self.visit(d) if d is not None else None for d in node.args.kw_defaults]
+        node.returns = None
+        return self.visit_scope(node)
+
+    visit_AsyncFunctionDef = visit_FunctionDef
+
+    def visit_Lambda(self, node):
+        node.args.defaults = [self.visit(d) for d in node.args.defaults]
+        node.args.kw_defaults = [self.visit(d) if d is not None else None for d in node.args.kw_defaults]
+        return self.visit_scope(node)
+
+    def visit_ClassDef(self, node):
+        strip_docstring(node)
+        return self.generic_visit(node)
+
+    def visit_arguments(self, node):
+        for a in node.posonlyargs + node.args + [node.vararg] + node.kwonlyargs + [node.kwarg]:
+            if a is not None:
+                a.annotation = None
+        return node
+
+    def visit_Name(self, node):
+        node.id = self.scopes[-1].get(node.id, node.id)
+        return node
+
+    def visit_ExceptHandler(self, node):
+        if node.name is not None:
+            node.name = self.scopes[-1].get(node.name, node.name)
+        return self.generic_visit(node)
+
+
+def normalize_code(code: str) -> str:
+    """Canonical dump of the code: comments, docstrings, formatting and local names don't matter"""
+    tree = ast.parse(code)
+    strip_docstring(tree)
+    tree = Normalizer().visit(tree)
+    return ast.dump(tree, annotate_fields=False, include_attributes=False)
+
+
+def fingerprint(impls: Dict[str, str]) -> Optional[str]:
+    """Fingerprint of a candidate (entity name -> code), or None if some implementation doesn't parse"""
+    try:
+        normalized = [(name, normalize_code(impl)) for name, impl in sorted(impls.items())]
+    except (SyntaxError, ValueError):
+        return None
+    return cache_key('fingerprint', normalized)
@@ -1,40 +1,345 @@
+import math
+import os
+import random
+import re
+import threading
+import time
+from functools import wraps
+
+import httpx
 import ollama
 import anthropic
-from typing import List
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import List, Dict, Tuple, Optional
+import openai
 from openai import OpenAI
 from google import genai
 
 from unvibe.magic import MagicEntity
-from unvibe.config import config
-from unvibe.disk_cache import disk_cached
+from unvibe.config import config, config_section
+from unvibe.log import log
+from unvibe.disk_cache import disk_cached, cache_key, normalize_text, last_call_was_cached
+from unvibe.usage import Usage, estimate_tokens
+
+
+def llm_cache_key(ai_config, system, prefix, suffix, temperature, expected=None, sample=0, samples=1, cancelled=None):
+    """
+    The key is a digest of the canonical request: provider, model, system, prompt and a quantized temperature.
+    The expected implementations and the cancel event are not part of it.
+    The samples of one prompt are different entries, so the first one has the same key as a single request.
+    """
+    parts = [ai_config['provider'], ai_config['model'],
+             normalize_text(system), normalize_text(prefix), normalize_text(suffix), round(float(temperature), 2)]
+    if sample != 0:
+        parts.append(['sample', sample])
+    if samples != 1:
+        parts.append(['samples', samples])
+    return cache_key(*parts), system + prefix + suffix
+
+
+cached = disk_cached(key_func=llm_cache_key)
+
+implement_re = re.compile(r'<implement name="(.+?)">(.*?)</implement>', re.DOTALL)
+implement_end_tag = '</implement>'
+
+
+class ImplementTracker:
+    """
+    Incremental parse_ai_output() of a streamed answer: tells when every expected <implement> tag is closed,
+    so that the stream can be stopped instead of paying for the commentary that often follows.
+    """
+
+    def __init__(self, expected):
+        self.expected = set(expected or [])
+        self.closed = set()
+        self.chunks = []  # the answer so far, joined only by answer()
+        self.pending = []  # the chunks after the last closed <implement>
+        self.end = 0  # where the last closed <implement> ends
+        self.window = ''  # the end of the answer, to find an end tag split between chunks
+
+    def feed(self, chunk) -> bool:
+        """Adds a chunk of the answer, returns True when all the expected implementations are closed"""
+        if chunk:
+            self.chunks.append(chunk)
+            self.pending.append(chunk)
+            window = self.window + chunk
+            self.window = window[-(len(implement_end_tag) - 1):]
+            if implement_end_tag in window:
+                # Only the text after the last closed tag is parsed again
+                pending = ''.join(self.pending)
+                end = 0
+                for match in implement_re.finditer(pending):
+                    self.closed.add(match.group(1))
+                    end = match.end()
+                self.end += end
+                self.pending = [pending[end:]]
+        return self.complete()
+
+    def complete(self) -> bool:
+        return len(self.expected) > 0 and self.expected <= self.closed
+
+    def answer(self) -> str:
+        """The answer up to the last closed tag if complete, otherwise all of it"""
+        text = ''.join(self.chunks)
+        return text[:self.end] if self.complete() else text
+
+
+# SDK clients of this process: (pid, client class, settings) -> client
+clients = {}
+clients_lock = threading.Lock()
+
+
+def get_client(client_class, **settings):
+    """
+    Returns the client built with these settings, creating it on the first call. The clients are thread-safe
+    and keep their connection pools, so the calls reuse the HTTP keep-alive connections and TLS sessions.
+    """
+    # A forked process can't use the connections of its parent
+    key = (os.getpid(), client_class, tuple(sorted(settings.items())))
+    with clients_lock:
+        client = clients.get(key)
+        if client is None:
+            client = client_class(**settings)
+            clients[key] = client
+    return client
+
+
+class LLMUnavailable(Exception):
+    """The provider kept failing after all the retries, or its circuit breaker is open"""
+
+
+class TokenBucket:
+    """Allows per_minute units per minute, in bursts of up to one minute worth of units"""
+
+    def __init__(self, per_minute):
+        self.capacity = per_minute
+        self.level = per_minute
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self, amount) -> float:
+        """Takes the units, going in debt if needed, and returns how many seconds to wait before using them"""
+        with self.lock:
+            now = time.monotonic()
+            self.level = min(self.capacity, self.level + (now - self.updated_at) * self.capacity / 60)
+            self.updated_at = now
+            self.level -= min(amount, self.capacity)
+            return max(0.0, -self.level * 60 / self.capacity)
+
+
+def status_code(exc):
+    """The HTTP status of the errors of the provider SDKs, or None"""
+    for attribute in ('status_code', 'code'):
+        value = getattr(exc, attribute, None)
+        if isinstance(value, int):
+            return value
+    return None
+
+
+def is_retryable(exc) -> bool:
+    if isinstance(exc, (anthropic.APIConnectionError, openai.APIConnectionError, httpx.TransportError,
+                        ConnectionError, TimeoutError)):
+        return True
+    status = status_code(exc)
+    return status is not None and (status in (408, 409, 429) or status >= 500)
+
+
+def retry_after(exc):
+    """Seconds to wait asked by the provider with the Retry-After header, or None"""
+    response = getattr(exc, 'response', None)
+    headers = getattr(response, 'headers', None) or {}
+    try:
+        return float(headers.get('retry-after'))
+    except (TypeError, ValueError):
+        return None
+
+
+class Scheduler:
+    """
+    Sends the requests to a provider within its rate limits (requests and tokens per minute), and retries
+    the rate-limited and failed ones with jittered exponential backoff, honoring Retry-After.
+    After breaker_failures consecutive failures the circuit opens: for breaker_seconds the calls fail
+    immediately with LLMUnavailable, instead of piling up on a provider that is down.
+    With max_concurrent, at most that many requests run at the same time, e.g. one per slot of Ollama.
+    """
+
+    def __init__(self, provider, requests_per_minute=None, tokens_per_minute=None, max_retries=5,
+                 backoff_seconds=1.0, max_backoff_seconds=60.0, breaker_failures=10, breaker_seconds=60.0,
+                 max_concurrent=None):
+        self.provider = provider
+        self.slots = threading.BoundedSemaphore(max_concurrent) if max_concurrent else None
+        self.requests = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.tokens = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.max_retries = max_retries
+        self.backoff_seconds = backoff_seconds
+        self.max_backoff_seconds = max_backoff_seconds
+        self.breaker_failures = breaker_failures
+        self.breaker_seconds = breaker_seconds
+        self.failures = 0  # consecutive
+        self.open_until = 0.0
+        self.lock = threading.Lock()
+
+    def wait_for_capacity(self, tokens):
+        wait = 0.0
+        if self.requests is not None:
+            wait = max(wait, self.requests.reserve(1))
+        if self.tokens is not None:
+            wait = max(wait, self.tokens.reserve(tokens))
+        if wait > 0:
+            time.sleep(wait)
+
+    def check_breaker(self):
+        with self.lock:
+            if time.monotonic() < self.open_until:
+                raise LLMUnavailable(f'{self.provider} failed {self.failures} times in a row, not calling it '
+                                     f'for {self.open_until - time.monotonic():.0f}s')
+
+    def record(self, failed: bool):
+        with self.lock:
+            if not failed:
+                self.failures = 0
+                return
+            self.failures += 1
+            if self.failures >= self.breaker_failures:
+                self.open_until = time.monotonic() + self.breaker_seconds
+
+    def backoff(self, attempt, exc) -> float:
+        wait = retry_after(exc)
+        if wait is None:
+            # Full jitter: the threads that failed together don't retry together
+            wait = random.uniform(0, min(self.max_backoff_seconds, self.backoff_seconds * 2 ** attempt))
+        return wait
+
+    def call(self, func, *args, tokens=0, **kwargs):
+        for attempt in range(self.max_retries + 1):
+            # Don't wait for capacity nor retry a request that is not needed anymore
+            check_cancelled(kwargs.get('cancelled'))
+            self.check_breaker()
+            self.wait_for_capacity(tokens)
+            try:
+                if self.slots is None:
+                    response = func(*args, **kwargs)
+                else:
+                    with self.slots:
+                        response = func(*args, **kwargs)
+            except Exception as exc:
+                if not is_retryable(exc):
+                    raise
+                self.record(failed=True)
+                if attempt == self.max_retries:
+                    raise LLMUnavailable(f'{self.provider} failed after {self.max_retries} retries: {exc}') from exc
+                wait = self.backoff(attempt, exc)
+                log(f'{self.provider} call failed ({exc}), retrying in {wait:.1f}s')
+                time.sleep(wait)
+                continue
+            self.record(failed=False)
+            # The output tokens are known only now
+            if self.tokens is not None and response.get('output_tokens'):
+                self.tokens.reserve(response['output_tokens'])
+            return response
+
+
+# Schedulers of this process: (provider, endpoint) -> Scheduler
+schedulers = {}
+schedulers_lock = threading.Lock()
+
+
+def get_scheduler(ai_config) -> Scheduler:
+    """The rate limits are per account: the models of a provider share its scheduler"""
+    key = (ai_config['provider'], ai_config.get('base_url') or ai_config.get('host'))
+    with schedulers_lock:
+        if key not in schedulers:
+            schedulers[key] = Scheduler(
+                ai_config['provider'],
+                requests_per_minute=ai_config.get('requests_per_minute'),
+                tokens_per_minute=ai_config.get('tokens_per_minute'),
+                max_retries=ai_config.get('max_retries', 5),
+                breaker_failures=ai_config.get('breaker_failures', 10),
+                breaker_seconds=ai_config.get('breaker_seconds', 60),
+                max_concurrent=ai_config.get('num_parallel'))
+        return schedulers[key]
+
+
+def scheduled(func):
+    """Runs the calls to the provider through its Scheduler. Applied below @cached: the cache hits are free"""
+
+    @wraps(func)
+    def wrapper(ai_config, system, prefix, suffix, *args, **kwargs):
+        scheduler = get_scheduler(ai_config)
+        return scheduler.call(func, ai_config, system, prefix, suffix, *args,
+                              tokens=estimate_tokens(system + prefix + suffix), **kwargs)
+
+    return wrapper
+
+
+class Cancelled(Exception):
+    """The request lost the race with its hedge, or the search ended: its partial answer must not be cached"""
 
-total_input_tokens = 0
-total_output_tokens = 0
 
-cached = disk_cached
+class AnyEvent:
+    """Set when any of its events is set: a request is cancelled by its hedge or by its search"""
+
+    def __init__(self, *events):
+        self.events = [event for event in events if event is not None]
+
+    def is_set(self) -> bool:
+        return any(event.is_set() for event in self.events)
+
+
+def check_cancelled(cancelled, stream=None):
+    if cancelled is not None and cancelled.is_set():
+        if stream is not None:
+            stream.close()
+        raise Cancelled()
+
+
+def make_response(text, input_tokens, output_tokens, model=None, texts=None, cached_input_tokens=None) -> Dict:
+    """
+    What the call_* functions return, and the cache saves: the answer and the usage reported by the provider.
+    When several samples are asked in one request, texts has all the answers and text is the first one.
+    cached_input_tokens are the input tokens read from the prompt cache of the provider.
+    """
+    return {'text': text, 'input_tokens': input_tokens, 'output_tokens': output_tokens, 'model': model,
+            'texts': texts, 'cached_input_tokens': cached_input_tokens}
 
 
 @cached
-def call_gemini(system, prompt, temperature):
-    client = genai.Client(api_key=config['ai']['api_key'])
-    resp = client.models.generate_content(
-        model=config['ai']['model'],
-        contents=system + '\n' + prompt,
+@scheduled
+def call_gemini(ai_config, system, prefix, suffix, temperature, expected=None, sample=0, cancelled=None):
+    client = get_client(genai.Client, api_key=ai_config['api_key'])
+    # Gemini caches the common prefix of the requests implicitly
+    stream = client.models.generate_content_stream(
+        model=ai_config['model'],
+        contents=system + '\n' + prefix + suffix,
     )
-    return resp.text
+    tracker = ImplementTracker(expected)
+    usage = None
+    for chunk in stream:
+        # Every chunk reports the usage so far
+        usage = chunk.usage_metadata or usage
+        check_cancelled(cancelled, stream)
+        if tracker.feed(chunk.text):
+            stream.close()
+            break
+    return make_response(tracker.answer(), getattr(usage, 'prompt_token_count', None),
+                         getattr(usage, 'candidates_token_count', None),
+                         cached_input_tokens=getattr(usage, 'cached_content_token_count', None))
 
 
 @cached
-def call_openai(system, prompt, temperature):
-    # TODO: plugin temperature
-    client = OpenAI(api_key=config['ai']['api_key'], base_url=config['ai']['base_url'])
-    resp = client.chat.completions.create(
-        model="deepseek-chat",
+@scheduled
+def call_openai(ai_config, system, prefix, suffix, temperature, expected=None, samples=1, cancelled=None):
+    # The Scheduler retries the failed requests: the retries of the SDK would multiply its attempts
+    client = get_client(OpenAI, api_key=ai_config['api_key'], base_url=ai_config['base_url'], max_retries=0)
+    # OpenAI and DeepSeek cache the longest common prefix of the requests automatically
+    stream = client.chat.completions.create(
+        model=ai_config['model'],
         messages=[
             {"role": "system", "content": system},
-            {"role": "user", "content": prompt},
+            {"role": "user", "content": prefix + suffix},
         ],
-        max_tokens=config['ai']['max_tokens'],
+        max_tokens=ai_config['max_tokens'],
         # From deepseek.com:
         # USE CASE                  TEMPERATURE
         # Coding / Math:	                0.0
@@ -43,39 +348,110 @@ def call_openai(system, prompt, temperature):
         # Translation:                      1.3
         # Creative Writing / Poetry:        1.5
         temperature=temperature,
-        stream=False
+        n=samples,
+        stream=True,
+        stream_options={'include_usage': True},
     )
-    # print('llm resp.choices[0].message.content:', resp.choices[0].message.content)
-    return resp.choices[0].message.content
+    # The chunks of the samples are interleaved, each one has the index of its sample. Some servers return
+    # fewer choices than n: only the indices that received content have a tracker, or the stream is never cut.
+    trackers = {}
+    model, usage = None, None
+    for chunk in stream:
+        model = chunk.model
+        # The usage comes in the last chunk, without choices
+        usage = chunk.usage or usage
+        check_cancelled(cancelled, stream)
+        for choice in chunk.choices:
+            if choice.delta.content:
+                trackers.setdefault(choice.index, ImplementTracker(expected)).feed(choice.delta.content)
+        if len(trackers) > 0 and all(tracker.complete() for tracker in trackers.values()):
+            stream.close()
+            break
+    texts = [trackers[index].answer() for index in sorted(trackers)]
+    texts = [text for text in texts if text] or ['']
+    # OpenAI reports the cached tokens in the details, DeepSeek as prompt cache hits
+    cached_input_tokens = getattr(getattr(usage, 'prompt_tokens_details', None), 'cached_tokens', None)
+    if cached_input_tokens is None and usage is not None:
+        cached_input_tokens = (usage.model_extra or {}).get('prompt_cache_hit_tokens')
+    return make_response(texts[0], getattr(usage, 'prompt_tokens', None), getattr(usage, 'completion_tokens', None),
+                         model=model, texts=texts, cached_input_tokens=cached_input_tokens)
 
 
 @cached
-def call_claude(system, prompt, temperature):
-    client = anthropic.Anthropic(api_key=config['ai']['api_key'])
-    message = client.messages.create(
-        model=config['ai']['model'],
-        max_tokens=1000,
-        temperature=temperature,
-        messages=[{"role": "user", "content": [{"type": "text", "text": prompt + '\n' + system}]}]
-    )
-    # print('llm output:', message.content)
-    global total_input_tokens, total_output_tokens
-    total_input_tokens += message.usage.input_tokens
-    total_output_tokens += message.usage.output_tokens
-    # input_tokens_cost_1M, output_tokens_cost_1M = 0.80, 4.00
-    # cost = (total_input_tokens * input_tokens_cost_1M + total_output_tokens * output_tokens_cost_1M) / 1_000_000
-    print(f'Total input tokens: {total_input_tokens}, Total output tokens: {total_output_tokens}')
-    return message.content[0].text
+@scheduled
+def call_claude(ai_config, system, prefix, suffix, temperature, expected=None, sample=0, cancelled=None):
+    client = get_client(anthropic.Anthropic, api_key=ai_config['api_key'], max_retries=0)  # see call_openai
+    tracker = ImplementTracker(expected)
+    # The system prompt and the prefix are cached up to the cache_control breakpoint
+    with client.messages.stream(
+            model=ai_config['model'],
+            max_tokens=1000,
+            temperature=temperature,
+            system=system,
+            messages=[{"role": "user", "content": [
+                {"type": "text", "text": prefix, "cache_control": {"type": "ephemeral"}},
+                {"type": "text", "text": suffix},
+            ]}]
+    ) as stream:
+        for text in stream.text_stream:
+            check_cancelled(cancelled)
+            if tracker.feed(text):
+                break
+        usage = stream.current_message_snapshot.usage
+    # When stopped early, the output tokens are not reported
+    output_tokens = None if tracker.complete() else usage.output_tokens
+    # input_tokens are only those after the cache breakpoint
+    cache_read = usage.cache_read_input_tokens or 0
+    input_tokens = usage.input_tokens + cache_read + (usage.cache_creation_input_tokens or 0)
+    return make_response(tracker.answer(), input_tokens, output_tokens, cached_input_tokens=cache_read)
+
+
+def ollama_options(ai_config, temperature=None) -> Dict:
+    options = {}
+    if temperature is not None:
+        options['temperature'] = temperature
+    # The context must hold the whole prompt: if Ollama truncates it, the cached prefix is lost
+    for key in ['num_ctx', 'num_predict']:
+        if key in ai_config:
+            options[key] = ai_config[key]
+    return options
 
 
 @cached
-def call_ollama(system, prompt, temperature, model):
-    client = ollama.Client(host=config['ai']['host'])
-    resp = client.generate(
-        model=model,
-        prompt='\n' + prompt + '\n' + system,
-        options=dict(temperature=temperature))
-    return resp.response
+@scheduled
+def call_ollama(ai_config, system, prefix, suffix, temperature, expected=None, sample=0, cancelled=None):
+    client = get_client(ollama.Client, host=ai_config['host'])
+    # Ollama reuses the KV cache of the slot for the longest common prefix of the prompts: the chat template
+    # puts the system and the stable prefix first, so the siblings only prefill the suffix
+    stream = client.chat(
+        model=ai_config['model'],
+        messages=[{'role': 'system', 'content': system}, {'role': 'user', 'content': prefix + suffix}],
+        options=ollama_options(ai_config, temperature),
+        keep_alive=ai_config.get('keep_alive', '30m'),
+        stream=True)
+    tracker = ImplementTracker(expected)
+    input_tokens, output_tokens = None, None
+    for chunk in stream:
+        if chunk.done:
+            input_tokens, output_tokens = chunk.prompt_eval_count, chunk.eval_count
+        check_cancelled(cancelled, stream)
+        if tracker.feed(chunk.message.content):
+            stream.close()
+            break
+    return make_response(tracker.answer(), input_tokens, output_tokens)
+
+
+def preload(ai_config):
+    """Loads the local model before the search needs it, and keeps it in memory for keep_alive"""
+    if ai_config['provider'] != 'ollama':
+        return
+    client = get_client(ollama.Client, host=ai_config['host'])
+    try:
+        # A request without messages only loads the model
+        client.chat(model=ai_config['model'], messages=[], options=ollama_options(ai_config),
+                    keep_alive=ai_config.get('keep_alive', '30m'))
+    except Exception as exc:
+        log(f'Could not preload {ai_config["model"]}: {exc}')
 
 
 example = '''
@@ -141,20 +517,153 @@ system = ("- You only write code inside the <implement> tags.\n"
           "- Don't write unit-tests. Don't change existing tests.\n")
 
 
-def ai_call(mes: List[MagicEntity], context, tests, errors, temperature) -> str:
-    assert context.strip() != '', 'Context should not be empty'  # TODO: Catch earlier
+def read_response(response, system, prompt) -> Dict:
+    """The tokens that the provider didn't report, e.g. when the stream was cut, are estimated"""
+    if response['input_tokens'] is None:
+        response = dict(response, input_tokens=estimate_tokens(system + prompt))
+    if response.get('texts') is None:
+        response = dict(response, texts=[response['text']])
+    if response['output_tokens'] is None:
+        response = dict(response, output_tokens=sum(estimate_tokens(text or '') for text in response['texts']))
+    return response
+
+
+def call_provider(ai_config, system, prefix, suffix, temperature, expected, **options) -> Tuple[Dict, bool]:
+    """Returns the answer of the provider of ai_config, and whether it came from the cache"""
+    provider = ai_config['provider']
+    if provider == 'claude':
+        response = call_claude(ai_config, system, prefix, suffix, temperature, expected=expected, **options)
+    elif provider == 'openai':
+        response = call_openai(ai_config, system, prefix, suffix, temperature, expected=expected, **options)
+    elif provider == 'gemini':
+        response = call_gemini(ai_config, system, prefix, suffix, temperature, expected=expected, **options)
+    elif provider == 'ollama':
+        response = call_ollama(ai_config, system, prefix, suffix, temperature, expected=expected, **options)
+    else:
+        raise NotImplementedError(f'{provider} not implemented')
+    response = read_response(response, system, prefix + suffix)
+    response = dict(response, provider=provider, model=response['model'] or ai_config['model'])
+    # The cache flag is per thread: read it in the thread that made the call
+    return response, last_call_was_cached()
+
+
+class LatencyTracker:
+    """Latencies of the last calls that missed the cache, to know which calls are unusually slow"""
+
+    def __init__(self, size=100):
+        self.latencies = deque(maxlen=size)
+        self.lock = threading.Lock()
+
+    def add(self, latency):
+        with self.lock:
+            self.latencies.append(latency)
+
+    def percentile(self, percent, min_calls=10) -> Optional[float]:
+        """None until there are min_calls latencies"""
+        with self.lock:
+            latencies = sorted(self.latencies)
+        if len(latencies) < min_calls:
+            return None
+        return latencies[max(0, math.ceil(percent / 100 * len(latencies)) - 1)]
+
+
+# (provider, model) -> LatencyTracker
+latency_trackers = {}
+latency_trackers_lock = threading.Lock()
+
+
+def get_latency_tracker(ai_config) -> LatencyTracker:
+    key = (ai_config['provider'], ai_config['model'])
+    with latency_trackers_lock:
+        if key not in latency_trackers:
+            latency_trackers[key] = LatencyTracker()
+        return latency_trackers[key]
+
+
+def hedge_config(ai_config) -> Dict:
+    """The [ai.hedge] table overrides the settings of [ai] for the hedged requests, e.g. with another model"""
+    overrides = ai_config.get('hedge', {})
+    return {**{k: v for k, v in ai_config.items() if k != 'hedge'}, **overrides}
+
+
+def call_hedged(ai_config, system, prefix, suffix, temperature, expected, cancelled=None, hedge_percentile=None,
+                **options) -> Tuple[Dict, bool, bool]:
+    """
+    Calls the provider, and if the answer takes longer than the hedge_percentile of the latencies of the last
+    calls, sends the same request to the [ai.hedge] provider (or the same one). The first good answer wins and
+    the other request is cancelled. Returns the answer, whether it came from the cache, and whether it was hedged.
+    Setting cancelled stops both requests.
+    """
+    tracker = get_latency_tracker(ai_config)
+    delay = tracker.percentile(hedge_percentile) if hedge_percentile is not None else None
+    started_at = time.monotonic()
+    if delay is None:
+        response, hit = call_provider(ai_config, system, prefix, suffix, temperature, expected, cancelled=cancelled,
+                                      **options)
+        if not hit:
+            tracker.add(time.monotonic() - started_at)
+        return response, hit, False
+
+    pool = ThreadPoolExecutor(max_workers=2)
+    cancel_events = [threading.Event(), threading.Event()]
+    try:
+        futures = [pool.submit(call_provider, ai_config, system, prefix, suffix, temperature, expected,
+                               cancelled=AnyEvent(cancel_events[0], cancelled), **options)]
+        done, _ = wait(futures, timeout=delay)
+        if len(done) == 0:
+            log(f'No answer after {delay:.1f}s, hedging the request')
+            futures.append(pool.submit(call_provider, hedge_config(ai_config), system, prefix, suffix, temperature,
+                                       expected, cancelled=AnyEvent(cancel_events[1], cancelled), **options))
+        hedged = len(futures) > 1
+        errors = []
+        pending = set(futures)
+        while len(pending) > 0:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    response, hit = future.result()
+                except Exception as exc:
+                    errors.append(exc)
+                    continue
+                if future is not futures[0] or not hit:
+                    # When the hedge wins, the latency of the primary is at least this: leaving it out of the
+                    # tracker would pull the percentile down
+                    tracker.add(time.monotonic() - started_at)
+                if hedged:
+                    # The loser processed the prompt too
+                    response = dict(response, input_tokens=response['input_tokens'] +
+                                    estimate_tokens(system + prefix + suffix))
+                return response, hit, hedged
+        raise errors[0]
+    finally:
+        # Also when the caller is interrupted: the loser stops streaming at its next chunk, without waiting
+        # for it here, as it may still be processing the prompt
+        for event in cancel_events:
+            event.set()
+        pool.shutdown(wait=False)
+
+
+def build_prompt(mes: List[MagicEntity], orig_context, context, tests, errors) -> Tuple[str, str]:
+    """
+    Returns the prompt as a prefix that is the same for every request of a search (examples, original sources
+    and tests), and a suffix with what changes (the current implementations and their errors).
+    The providers cache the prefix, and only the suffix is processed again.
+    """
     func_names_str = ', '.join([me.name for me in mes])
     errors_tag = ''
     fix_msg = ''
     if len(errors) > 0:
         errors_tag = '<errors>\n' + '\n'.join(errors) + '</errors>'
         fix_msg = 'Fix the errors! you have already tried many times, must try something else.'
-    prompt = f'''
+    prefix = f'''
 {example}
 <input>
-{context}
+{orig_context}
 
 {tests}
+'''
+    suffix = f'''
+{context}
 
 {errors_tag}
 </input>
@@ -162,15 +671,49 @@ def ai_call(mes: List[MagicEntity], context, tests, errors, temperature) -> str:
 Implement the functions: {func_names_str}
 {fix_msg}
 '''
-    provider = config['ai']['provider']
-    if provider == 'claude':
-        resp_text = call_claude(system, prompt, temperature)
-    elif provider == 'openai':
-        resp_text = call_openai(system, prompt, temperature)
-    elif provider == 'gemini':
-        resp_text = call_gemini(system, prompt, temperature)
-    elif provider == 'ollama':
-        resp_text = call_ollama(system, prompt, temperature, model=config['ai']['model'])
+    return prefix, suffix
+
+
+def ai_call(mes: List[MagicEntity], orig_context, context, tests, errors, temperature, samples=1,
+            ai_config=None, cancelled=None, search_config=None) -> Tuple[str, List[str], Usage]:
+    """
+    Returns the full prompt, the answers of the LLM and the usage of the call. The context is what the state
+    changed of the orig_context. With samples > 1 the prompt is sent once and the LLM returns that many answers:
+    in one request where the provider supports it (OpenAI `n`), otherwise in parallel requests.
+    When the event cancelled is set, the streams are closed and Cancelled is raised.
+    The settings are those of [ai] and [search], unless ai_config and search_config are given.
+    """
+    assert (orig_context + context).strip() != '', 'Context should not be empty'  # TODO: Catch earlier
+    prefix, suffix = build_prompt(mes, orig_context, context, tests, errors)
+    ai_config = ai_config or config['ai']
+    if search_config is None:
+        search_config = config_section('search')
+    hedge_percentile = search_config.get('hedge_percentile')
+    provider = ai_config['provider']
+    started_at = time.monotonic()
+    # The answer is streamed, and cut as soon as all these are implemented
+    expected = [me.name for me in mes]
+    if provider == 'openai':
+        responses = [call_hedged(ai_config, system, prefix, suffix, temperature, expected, cancelled,
+                                 hedge_percentile, samples=samples)]
+    elif samples == 1:
+        responses = [call_hedged(ai_config, system, prefix, suffix, temperature, expected, cancelled,
+                                 hedge_percentile)]
     else:
-        raise NotImplementedError(f'{provider} not implemented')
-    return system + prompt, resp_text
+        # One request per sample, at the same time: Ollama serves them in its parallel slots
+        with ThreadPoolExecutor(max_workers=samples) as pool:
+            futures = [pool.submit(call_hedged, ai_config, system, prefix, suffix, temperature, expected, cancelled,
+                                   hedge_percentile, sample=i) for i in range(samples)]
+            responses = [future.result() for future in futures]
+    latency = time.monotonic() - started_at
+    texts = [text for response, _, _ in responses for text in response['texts']]
+    cache_hit = all(hit for _, hit, _ in responses)
+    # Only the samples that missed the cache cost something
+    billed = [response for response, hit, _ in responses if cache_hit or not hit]
+    usage = Usage(provider, responses[0][0]['model'],
+                  sum(response['input_tokens'] for response in billed),
+                  sum(response['output_tokens'] for response in billed),
+                  latency, cache_hit, samples=len(texts),
+                  cached_input_tokens=sum(response.get('cached_input_tokens') or 0 for response in billed),
+                  hedged=sum(1 for _, _, hedged in responses if hedged))
+    return system + prefix + suffix, texts, usage
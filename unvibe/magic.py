@@ -1,7 +1,6 @@
 import re
-import sys
 import inspect
-import traceback
+import builtins
 from typing import Union, Type
 
 from termcolor import colored
@@ -22,22 +21,6 @@ def as_short_code(code, max_len=150):
     return short_code
 
 
-def split_imports_and_code(impl):
-    imports = []
-    lines = impl.split('\n')
-    for i, line in enumerate(lines):
-        clean_line = line.strip()
-        if line == '':
-            continue
-        elif clean_line.startswith('import ') or clean_line.startswith('from '):
-            imports.append(line)
-        else:
-            break
-    code = '\n'.join(lines[i:])
-    imports = '\n'.join(imports)
-    return imports, code
-
-
 def cleanup_implementation(code, cls: Union[Type['MagicFunction'], Type['MagicClass']]):
     code = remove_indentation(code, cls)
     code = remove_annotation(code)
@@ -105,22 +88,36 @@ class MagicFunction(MagicEntity):
         short_code = as_short_code(self.orig_code)
         return f'MagicFunction({short_code}...)'
 
+    _impl_obj = None  # the function or class defined by impl
+    _impl_error = None  # the exception raised defining impl, re-raised when the entity is called
+    _impl_traceback = None
+
+    def set_impl(self, impl):
+        super().set_impl(impl)
+        self._impl_obj = None
+        self._impl_error = None
+        self._impl_traceback = None
+        if impl is None:
+            return
+        # Compile and define the implementation only once, in a namespace private to this entity
+        namespace = {'__name__': f'{self.name}_impl', '__builtins__': builtins}
+        try:
+            exec(compile(impl, '<string>', 'exec'), namespace)
+            if self.name not in namespace:
+                raise NameError(f"name '{self.name}' is not defined")
+            self._impl_obj = namespace[self.name]
+        except Exception as exc:
+            self._impl_error = exc
+            self._impl_traceback = exc.__traceback__
+
     def __call__(self, *args, **kwargs):
         if self.impl is None:
             raise Exception(f'Implementation not set for {self}.\n\n{impl_is_none_msg}')
 
-        imports, code = split_imports_and_code(self.impl)
-        ___eval = eval
-        try:
-            exec(imports, globals())  # run the imports
-            exec(code, globals())  # define the function
-        except IndentationError as exc:
-            traceback.print_exc()
-            print('IndentationError produced with:')
-            print('Imports:', imports)
-            print('Code:', code)
-            sys.exit(1)
-        return ___eval(f'{self.name}(*args, **kwargs)')  # then call it
+        if self._impl_error is not None:
+            exc = self._impl_error
+            raise exc.with_traceback(self._impl_traceback)
+        return self._impl_obj(*args, **kwargs)
 
 
 class MagicClass(MagicFunction):
@@ -0,0 +1,99 @@
+import ast
+import builtins
+import inspect
+from typing import Optional
+
+from unvibe.magic import MagicEntity, MagicClass
+
+module_names = {'__name__', '__file__', '__doc__', '__builtins__', '__class__'}
+
+
+def check_syntax(code: str) -> Optional[str]:
+    try:
+        compile(code, '<string>', 'exec')
+    except SyntaxError as exc:
+        text = (exc.text or '').rstrip()
+        return f'{type(exc).__name__}: {exc.msg} (line {exc.lineno})\n    {text}'
+    return None
+
+
+def find_definition(tree: ast.Module, me: MagicEntity):
+    kinds = (ast.ClassDef,) if isinstance(me, MagicClass) else (ast.FunctionDef, ast.AsyncFunctionDef)
+    for node in tree.body:
+        if isinstance(node, kinds) and node.name == me.name:
+            return node
+    return None
+
+
+def check_signature(definition: ast.FunctionDef, me: MagicEntity) -> Optional[str]:
+    """The implementation must accept the positional arguments of the original definition"""
+    try:
+        orig_signature = inspect.signature(me.orig)
+    except (TypeError, ValueError):
+        return None
+    positional_kinds = (inspect.Parameter.POSITIONAL_ONLY, inspect.Parameter.POSITIONAL_OR_KEYWORD)
+    orig_positional = [p for p in orig_signature.parameters.values() if p.kind in positional_kinds]
+    args = definition.args
+    positional = args.posonlyargs + args.args
+    required = len(positional) - len(args.defaults)
+    if required > len(orig_positional) or (len(positional) < len(orig_positional) and args.vararg is None):
+        impl_signature = ast.unparse(args) if hasattr(ast, 'unparse') else ', '.join(a.arg for a in positional)
+        return f'TypeError: {me.name}({impl_signature}) must accept the same arguments as {me.name}{orig_signature}'
+    return None
+
+
+def bound_names(tree: ast.Module) -> Optional[set]:
+    """Every name the code defines anywhere, or None if it uses `from ... import *`"""
+    names = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name) and isinstance(node.ctx, (ast.Store, ast.Del)):
+            names.add(node.id)
+        elif isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            names.add(node.name)
+        elif isinstance(node, ast.arg):
+            names.add(node.arg)
+        elif isinstance(node, (ast.Import, ast.ImportFrom)):
+            for alias in node.names:
+                if alias.name == '*':
+                    return None
+                names.add(alias.asname or alias.name.split('.')[0])
+        elif isinstance(node, ast.ExceptHandler) and node.name is not None:
+            names.add(node.name)
+        elif isinstance(node, (ast.Global, ast.Nonlocal)):
+            names.update(node.names)
+        elif getattr(node, 'name', None) is not None and type(node).__name__ in ('MatchAs', 'MatchStar'):
+            names.add(node.name)
+        elif type(node).__name__ == 'MatchMapping' and node.rest is not None:
+            names.add(node.rest)
+    return names
+
+
+def check_undefined_names(tree: ast.Module) -> Optional[str]:
+    names = bound_names(tree)
+    if names is None:
+        return None
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name) and isinstance(node.ctx, ast.Load) and node.id not in names \
+                and node.id not in module_names and not hasattr(builtins, node.id):
+            return f"NameError: name '{node.id}' is not defined (line {node.lineno})"
+    return None
+
+
+def prescreen(code: str, me: MagicEntity) -> Optional[str]:
+    """
+    Static checks of an implementation, before running the tests: it must compile, define the entity,
+    accept its arguments and not use undefined names. Returns the error for the LLM, or None.
+    """
+    error = check_syntax(code)
+    if error is not None:
+        return error
+    tree = ast.parse(code)
+    definition = find_definition(tree, me)
+    if definition is None:
+        kind = 'class' if isinstance(me, MagicClass) else 'def'
+        return f'Expected a top-level "{kind} {me.name}" in the implementation of {me.name}.'
+    if not isinstance(me, MagicClass):
+        error = check_signature(definition, me)
+        if error is not None:
+            return error
+    return check_undefined_names(tree)
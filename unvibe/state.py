@@ -1,6 +1,7 @@
 from typing import Dict, List
 
 from unvibe import MagicEntity
+from unvibe.usage import Usage
 
 
 class State:
@@ -18,6 +19,9 @@ class State:
     executed_assertions: int
     failed_assertions: int
     children: List['State']
+    duplicates: int  # how many later candidates were the same code as this one
+    usage: Usage  # tokens and latency of the LLM call that generated this state
+    usage_summary: Dict  # only in the root: the totals of the search
     temperature: float = None
     count = None
 
@@ -36,17 +40,31 @@ class State:
         self.executed_assertions: int = 0
         self.failed_assertions: int = 0
         self.children: List['State'] = []
+        self.duplicates: int = 0
+        self.usage: Usage = None
+        self.usage_summary: Dict = None
         self.temperature: float = None
         self.count = None
 
-    def build_context_from_magic_entities(self):
+    def build_context_from_magic_entities(self, impls: Dict[str, str] = None):
+        """Uses the given implementations (name -> code) instead of the ones set in the magic entities"""
         context = self.orig_context
         for mf in self.mes:
-            context += (mf.impl if mf.impl is not None else mf.clean_orig_code) + '\n'
+            impl = impls.get(mf.name) if impls is not None else mf.impl
+            context += (impl if impl is not None else mf.clean_orig_code) + '\n'
         return context
 
+    def changed_context(self) -> str:
+        """What this state added to orig_context: the implementations"""
+        if self.context is None:
+            return ''
+        if self.context.startswith(self.orig_context):
+            return self.context[len(self.orig_context):]
+        return self.context
+
     def __repr__(self):
-        return f'State(#{self.count}, score={self.score:.2f}, errors={len(self.errors)}, temp={self.temperature:.3f})'
+        return (f'State(#{self.count}, score={self.score:.2f}, errors={len(self.errors)}, temp={self.temperature:.3f}, '
+                f'duplicates={self.duplicates})')
 
     def short_repr(self):
         return f'<#{self.count}, {self.score:.2f}, {len(self.errors)}, {self.temperature:.3f}>'
@@ -67,6 +85,9 @@ class State:
             'executed_assertions': self.executed_assertions,
             'failed_assertions': self.failed_assertions,
             'temperature': self.temperature,
+            'duplicates': self.duplicates,
+            'usage': self.usage.to_dict() if self.usage is not None else None,
+            'usage_summary': self.usage_summary,
             'children': [child.to_dict() for child in self.children],
             'short_repr': self.short_repr()
         }
@@ -25,12 +25,47 @@ def import_from_path(module_name, file_path):
     return module
 
 
+def index_tests(test_suite: TestSuite) -> list:
+    """
+    Flattens the suite into (TestCase class, method name) pairs, that can be instantiated again for each run.
+    Tests that can't be instantiated again, like the ones reporting import errors, are kept as they are.
+    """
+    index = []
+    for test in test_suite:
+        if isinstance(test, TestSuite):
+            index += index_tests(test)
+            continue
+        try:
+            type(test)(test._testMethodName)
+            index.append((type(test), test._testMethodName))
+        except Exception:
+            index.append(test)
+    return index
+
+
 class TestsContainer:
     def __init__(self):
-        pass
+        self.test_index = None
+
+    def index_tests(self):
+        """Discovers the tests, only once. It imports the test modules, which register the @ai entities."""
+        if self.test_index is None:
+            self.test_index = index_tests(self.discover())
+        return self.test_index
 
-    @abstractmethod
     def generate_test_suite(self) -> TestSuite:
+        """A new suite with new TestCase instances, because a suite can be run only once"""
+        tests = []
+        for entry in self.index_tests():
+            if isinstance(entry, tuple):
+                test_case_class, method_name = entry
+                tests.append(test_case_class(method_name))
+            else:
+                tests.append(entry)
+        return CountingTestSuite(tests)
+
+    @abstractmethod
+    def discover(self) -> TestSuite:
         pass
 
     @abstractmethod
@@ -44,9 +79,10 @@ class TestsContainer:
 
 class ClassTestsContainer(TestsContainer):
     def __init__(self, test_suite: TestSuite):
+        super().__init__()
         self.test_suite = test_suite
 
-    def generate_test_suite(self) -> TestSuite:
+    def discover(self) -> TestSuite:
         loader = TestLoader()
         loader.suiteClass = CountingTestSuite
         test_suite = loader.loadTestsFromTestCase(self.test_suite)
@@ -80,7 +116,7 @@ class FolderPatternTestsContainer(TestsContainer):
         ctx = '\n'.join([f.read_text() for f in tests_file_names])
         return ctx
 
-    def generate_test_suite(self):
+    def discover(self):
         if Path(self.test_folder).is_file():
             module = import_from_path('module', self.test_folder)
             return unittest.TestLoader().loadTestsFromModule(module)
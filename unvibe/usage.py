@@ -0,0 +1,75 @@
+from typing import List, Dict
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count of a text, about 4 characters per token"""
+    return len(text) // 4 + 1
+
+
+class Usage:
+    """What one ai_call cost: the tokens are those reported by the provider, or estimated if it didn't"""
+    provider: str
+    model: str
+    input_tokens: int
+    output_tokens: int
+    latency: float  # seconds, including the cache lookup
+    cache_hit: bool  # the answer came from the cache, and cost nothing
+    samples: int  # how many answers the call returned
+    cached_input_tokens: int  # input tokens read from the prompt cache of the provider
+    hedged: int  # how many of its requests were slow, and were sent again
+
+    def __init__(self, provider, model, input_tokens, output_tokens, latency, cache_hit, samples=1,
+                 cached_input_tokens=0, hedged=0):
+        self.provider = provider
+        self.model = model
+        self.input_tokens = input_tokens
+        self.output_tokens = output_tokens
+        self.latency = latency
+        self.cache_hit = cache_hit
+        self.samples = samples
+        self.cached_input_tokens = cached_input_tokens
+        self.hedged = hedged
+
+    def billed_tokens(self) -> int:
+        return 0 if self.cache_hit else self.input_tokens + self.output_tokens
+
+    def __repr__(self):
+        return (f'Usage({self.provider}/{self.model}, in={self.input_tokens}, out={self.output_tokens}, '
+                f'latency={self.latency:.2f}s, cache_hit={self.cache_hit})')
+
+    def to_dict(self):
+        return {
+            'provider': self.provider,
+            'model': self.model,
+            'input_tokens': self.input_tokens,
+            'output_tokens': self.output_tokens,
+            'latency': self.latency,
+            'cache_hit': self.cache_hit,
+            'samples': self.samples,
+            'cached_input_tokens': self.cached_input_tokens,
+            'hedged': self.hedged,
+        }
+
+
+def summarize_usage(usages: List[Usage]) -> Dict:
+    """Totals of a run. Only the calls that missed the cache are billed"""
+    misses = [u for u in usages if not u.cache_hit]
+    return {
+        'llm_calls': len(usages),
+        'samples': sum(u.samples for u in usages),
+        'cache_hits': len(usages) - len(misses),
+        'hedged': sum(u.hedged for u in usages),
+        'input_tokens': sum(u.input_tokens for u in misses),
+        'cached_input_tokens': sum(u.cached_input_tokens for u in misses),
+        'output_tokens': sum(u.output_tokens for u in misses),
+        'latency': sum(u.latency for u in usages),
+        'max_latency': max((u.latency for u in usages), default=0),
+    }
+
+
+def format_usage_summary(summary: Dict) -> str:
+    return (f"{summary['llm_calls']} LLM calls ({summary['cache_hits']} from the cache, {summary['hedged']} hedged), "
+            f"{summary['samples']} answers, "
+            f"{summary['input_tokens']} input tokens ({summary['cached_input_tokens']} from the prompt cache), "
+            f"{summary['output_tokens']} output tokens, "
+            f"{summary['latency']:.1f}s waiting for the LLM (slowest call {summary['max_latency']:.1f}s)")